@@ -1,29 +1,40 @@
 # conda install spacy
 # python -m spacy download en_core_web_lg
 
-import spacy
 import os
 import json
 import string
+import collections
 import re
-import neuralcoref
 import itertools
 import requests
 import datetime
 import nltk
+import time
+import atexit
+import threading
+import contextlib
 
 from os.path import join, dirname
 from dotenv import load_dotenv
 from bert import Bert
 from chatbot import Chatbot
 from controller import Controller
+from cache import AnswerCache, SemanticCache
+from assets import NLTK_DATA, require
+from coref import CorefContext, doc_tokens, extract_mentions, resolve_conversation
+from pipelines import PROFILES, load_pipelines, word_class
+from nlp_service import NlpService, analyze_queries, text_vectors as pipeline_vectors
+from startup import Startup
+from rerank import make_reranker
+from passage_store import PassageStore
+from titles import TitleIndex, definition_subject
+from dense_index import DenseIndex, reciprocal_rank_fusion
 from flask import Flask, request, abort, jsonify, render_template
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import MultiSearch, Search
 from spacy.lang.en.stop_words import STOP_WORDS
 from datetime import datetime
-from spacy.tokenizer import Tokenizer
-from spacy.util import compile_infix_regex
 
 app = Flask(__name__)
 
@@ -31,25 +42,165 @@ app = Flask(__name__)
 dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 
-bert = Bert()
-chatbot = Chatbot(os.getenv('ChatbotModelName'),
-                  os.getenv('ChatbotDataFile'),
-                  int(os.getenv('ChatbotNbIterations')))
-controller = Controller()
-
-nlp = spacy.load('en_core_web_lg')
-neuralcoref.add_to_pipe(nlp)
-nltk.download('punkt')
+# Sentence splitting model installed by assets.py, nltk never downloads it at startup
+require('nltk_punkt')
+nltk.data.path.insert(0, NLTK_DATA)
+
+nlp_roles = ['query', 'mentions'] if os.getenv('IncrementalCoref') else ['query', 'coref']
+nlp_overrides = {}
+if os.getenv('SpacyQueryModel'):
+    nlp_overrides['query'] = os.getenv('SpacyQueryModel')
+if os.getenv('SpacyCorefModel'):
+    nlp_overrides['mentions'] = nlp_overrides['coref'] = os.getenv('SpacyCorefModel')
+
+def load_nlp():
+    # Returns the local pipelines or the service running them in worker processes
+    if int(os.getenv('NlpProcesses')) > 0:
+        return None, NlpService(int(os.getenv('NlpProcesses')), os.getenv('SpacyProfile'),
+                                nlp_roles, nlp_overrides,
+                                batch_size=int(os.getenv('NlpBatchSize')),
+                                wait=float(os.getenv('NlpBatchWait')))
+    return load_pipelines(os.getenv('SpacyProfile'), nlp_roles, nlp_overrides), None
+
+# The models are loaded concurrently in the background, requests are refused
+# with 503 until /readyz reports that every component is loaded
+bert = None
+chatbot = None
+controller = None
+nlp = None
+nlp_service = None
+
+startup = Startup()
+startup.add('bert', Bert)
+startup.add('chatbot', lambda: Chatbot(os.getenv('ChatbotModelName'),
+                                       os.getenv('ChatbotDataFile'),
+                                       int(os.getenv('ChatbotNbIterations')),
+                                       os.getenv('ChatbotVocFile'),
+                                       os.getenv('ChatbotSlimCheckpoint')))
+startup.add('controller', Controller)
+startup.add('nlp', load_nlp)
+
+def on_loaded(components):
+    global bert, chatbot, controller, nlp, nlp_service, semantic_cache
+    bert = components['bert']
+    chatbot = components['chatbot']
+    controller = components['controller']
+    nlp, nlp_service = components['nlp']
+    if passage_store is not None and passage_store.manifest['vocab_size'] != len(bert.tokenizer.vocab):
+        raise ValueError("PassageStore was built with another BERT vocabulary")
+    if nlp_service is not None:
+        atexit.register(nlp_service.shutdown)
+    if os.getenv('SemanticCache'):
+        semantic_cache = make_semantic_cache()
 
 ES_HOST = os.getenv('Host')
 ES_PORT = os.getenv('Port')
 ES_INDEX = os.getenv('Index')
-
-sessions = []
+# Index of pre-split passages written by ingest_passages.py, searched instead of
+# the article index when set
+PASSAGE_INDEX = os.getenv('PassageIndex')
+SEARCH_INDEX = PASSAGE_INDEX or ES_INDEX
+# WordPiece tokenization of the passage index, written by ingest_passages.py
+passage_store = PassageStore(os.getenv('PassageStore')) if PASSAGE_INDEX and os.getenv('PassageStore') else None
+# Titles and redirects of the article index, written by titles.py
+title_index = TitleIndex(os.getenv('TitleDictionary')) if os.getenv('TitleDictionary') else None
+# Dense vectors of the passage index, written by dense_index.py
+dense_index = None
+if PASSAGE_INDEX and os.getenv('DenseIndex'):
+    dense_index = DenseIndex(os.getenv('DenseIndex'), probes=int(os.getenv('DenseProbes')),
+                             candidates=int(os.getenv('DenseCandidates')))
+    # The questions must be embedded with the word vectors of the passages
+    query_model = nlp_overrides.get('query', PROFILES[os.getenv('SpacyProfile')]['query'])
+    if dense_index.manifest['model'] != query_model or dense_index.manifest['index'] != PASSAGE_INDEX:
+        raise ValueError("DenseIndex was built with {} on {}".format(
+            dense_index.manifest['model'], dense_index.manifest['index']))
+
+es = Elasticsearch([ES_HOST], port=ES_PORT)
+
+answer_cache = None
+if os.getenv('AnswerCache'):
+    answer_cache = AnswerCache(int(os.getenv('AnswerCacheSize')),
+                               ttl=int(os.getenv('AnswerCacheTTL')),
+                               path=os.getenv('AnswerCacheFile'))
+    answer_cache.load()
+    atexit.register(answer_cache.save)
+index_version = { 'value': None, 'checked': 0 }
+
+# Answers of paraphrased questions, found by the similarity of their spaCy
+# vectors, created once the query model is loaded
+semantic_cache = None
+
+def make_semantic_cache():
+    # The width of the vectors depends on the query model of SpacyProfile
+    if nlp_service is not None:
+        dimensions = nlp_service.vectors_length()
+    else:
+        dimensions = nlp['query'].vocab.vectors_length
+    if not dimensions:
+        print('*** SemanticCache disabled: the query model has no word vectors ***')
+        return None
+    return SemanticCache(int(os.getenv('SemanticCacheSize')), dimensions,
+                         threshold=float(os.getenv('SemanticCacheThreshold')),
+                         ttl=int(os.getenv('AnswerCacheTTL')))
+
+# Early exits of the cascade over the passages, their answers are compared
+# with a full read offline by `evaluate_qa.py --cascade-audit`
+cascade_stats = collections.OrderedDict([
+    ('questions', 0), ('early_exits', 0), ('passages_retrieved', 0), ('passages_read', 0)
+])
+cascade_lock = threading.Lock()
+
+# Definition questions answered from the opening text of the article they name
+title_stats = collections.OrderedDict([('questions', 0), ('matches', 0), ('answers', 0)])
+title_lock = threading.Lock()
+
+# Optional re-ranking of the passages between retrieval and BERT, which also
+# chooses how many of them are read
+reranker = None
+if os.getenv('PassageReranker'):
+    reranker_options = {
+        'min_passages': int(os.getenv('RerankMinPassages')),
+        'max_passages': int(os.getenv('RerankMaxPassages')),
+        'keep_ratio': float(os.getenv('RerankKeepRatio'))
+    }
+    if os.getenv('PassageReranker') == 'bm25':
+        reranker_options['stop_words'] = STOP_WORDS
+    elif os.getenv('PassageReranker') == 'vectors':
+        reranker_options['vectors'] = lambda texts: text_vectors(texts)
+    reranker = make_reranker(os.getenv('PassageReranker'), **reranker_options)
+
+# Conversation of each session id, least recently used first. Sessions idle for
+# more than SessionTTL seconds, or the oldest above MaxSessions, are dropped.
+sessions = collections.OrderedDict()
+sessions_lock = threading.Lock()
+
+def touch_session(sessionID):
+    now = time.time()
+    with sessions_lock:
+        session = sessions.get(sessionID)
+        if session is None:
+            session = {
+                'id': sessionID,
+                'chat': [],
+                'coref': CorefContext(int(os.getenv('TemporalDistanceContext')))
+            }
+            sessions[sessionID] = session
+        session['last_seen'] = now
+        sessions.move_to_end(sessionID)
+        while sessions:
+            oldest = next(iter(sessions.values()))
+            if now - oldest['last_seen'] > int(os.getenv('SessionTTL')) or len(sessions) > int(os.getenv('MaxSessions')):
+                sessions.popitem(last=False)
+            else:
+                break
+    return session
 
 
 @app.route('/', methods=['POST'])
 def answer():
+    if not startup.ready.is_set():
+        abort(503) # Service Unavailable
+
     req_data = request.get_json()
 
     if not contains_query_text(req_data):
@@ -64,32 +215,26 @@ def answer():
     if not answer:
         answer = 'I don\'t know'
 
-    for session in sessions:
-        if session['id'] == sessionID:
-            session['chat'].append({
-                'query': query,
-                'query_coref_resolved': query_coref_resolved,
-                'answer': answer,
-                'label': label,
-                'titleAnswerPage': title
-            })
-            break
+    session = touch_session(sessionID)
+
+    session['chat'].append({
+        'query': query,
+        'query_coref_resolved': query_coref_resolved,
+        'answer': answer,
+        'label': label,
+        'titleAnswerPage': title
+    })
+
+    # Only the last consecutive QA turns are used as coreference context
+    if label == 'QA':
+        session['coref'].add_turn(query_coref_resolved, answer)
     else:
-        sessions.append({
-            'id': sessionID,
-            'chat': [{
-                'query': query,
-                'query_coref_resolved': query_coref_resolved,
-                'answer': answer,
-                'label': label,
-                'titleAnswerPage': title
-            }]
-        })
+        session['coref'].reset()
 
     '''
     if base_query == 'debug':
         print('\n***DEBUG***')
-        for session in sessions:
+        for session in sessions.values():
             print('id: ' + session['id'])
             for chat in session['chat']:
                 print('  query: ' + chat['query'])
@@ -103,6 +248,7 @@ def answer():
     today = datetime.now()
     with open('dump/%s.json' % today.strftime("%A-%d-%b-%Y"), 'a') as f:
         f.write('%s\n' % json.dumps({
+                'session': sessionID,
                 'query': query,
                 'answer': answer,
                 'label_controller': label,
@@ -121,6 +267,29 @@ def answer():
     return jsonify({ 'fulfillmentText': answer })
 
 
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'answer_cache': answer_cache.stats() if answer_cache is not None else None,
+        'semantic_cache': semantic_cache.stats() if semantic_cache is not None else None,
+        'passage_cache': bert.passage_cache.stats() if bert is not None else None,
+        'cascade': cascade_stats if os.getenv('CascadeMode') else None,
+        'title_fast_path': title_stats if title_index is not None else None
+    })
+
+
+@app.route('/healthz')
+def healthz():
+    # The process is up, even while the models are loading
+    return jsonify({ 'phase': startup.phase }), 200 if startup.error is None else 500
+
+
+@app.route('/readyz')
+def readyz():
+    # Load time and memory of each component, 200 once they are all loaded and warm
+    return jsonify(startup.status()), 200 if startup.ready.is_set() else 503
+
+
 @app.route('/chat')
 def index():
     return render_template("index.html")
@@ -128,6 +297,9 @@ def index():
 
 @app.route("/get")
 def get_bot_response():
+    if not startup.ready.is_set():
+        abort(503) # Service Unavailable
+
     question = request.args.get('msg')
     
     #question = ' '.join(userText)
@@ -183,44 +355,87 @@ def clean_answer(answer):
 
 def resolve_pronouns(query, sessionID):
     if contains_pronoun(query):
-        for session in sessions:
-            if session['id'] == sessionID:
-                reversed_chats = list(reversed(session['chat']))
-                last_qa_chats = list(itertools.takewhile(lambda c: c['label'] == 'QA', reversed_chats))
-                last_n_chats = last_qa_chats[:int(os.getenv('TemporalDistanceContext'))]
-                unreversed_chats = list(reversed(last_n_chats))
-                iter_chats = iter(unreversed_chats)
-
-                conversation = ''
-                try:
-                    first_chat = next(iter_chats)
+        session = sessions.get(sessionID)
+        if session is not None:
+            if os.getenv('IncrementalCoref'):
+                return resolve_pronouns_incremental(query, session['coref'])
+
+            reversed_chats = list(reversed(session['chat']))
+            last_qa_chats = list(itertools.takewhile(lambda c: c['label'] == 'QA', reversed_chats))
+            last_n_chats = last_qa_chats[:int(os.getenv('TemporalDistanceContext'))]
+            unreversed_chats = list(reversed(last_n_chats))
+            iter_chats = iter(unreversed_chats)
+
+            conversation = ''
+            try:
+                first_chat = next(iter_chats)
+
+                conversation += first_chat['query_coref_resolved'] + '. ' + first_chat['answer']
+
+                for chat in iter_chats:
+                    conversation += '. ' + chat['query_coref_resolved'] + '. ' + chat['answer']
+            except StopIteration:
+                pass
+            finally:
+                del iter_chats
+
+            if conversation:
+                conversation += '. ' + query + '.'
+            else:
+                conversation += query + '.'
 
-                    conversation += first_chat['query_coref_resolved'] + '. ' + first_chat['answer']
+            query_result = query
 
-                    for chat in iter_chats:
-                        conversation += '. ' + chat['query_coref_resolved'] + '. ' + chat['answer']
-                except StopIteration:
-                    pass
-                finally:
-                    del iter_chats
+            query_coref_resolved = coref_resolve(conversation)
+            query_result = query_coref_resolved.rstrip('.')
 
-                if conversation:
-                    conversation += '. ' + query + '.'
-                else:
-                    conversation += query + '.'
+            return (query_result, conversation)
 
-                query_result = query
+    return (query, '')
 
-                conv_nlp = nlp(conversation)
-                conv_coref_resolved = conv_nlp._.coref_resolved
-                conv_coref_resolved_nlp = nlp(conv_coref_resolved)
-                conv_sentences = list(conv_coref_resolved_nlp.sents)
-                query_coref_resolved = str(conv_sentences[-1])
-                query_result = query_coref_resolved.rstrip('.')
+def resolve_pronouns_incremental(query, coref):
+    if not coref.turns:
+        return (query, '')
 
-                return (query_result, conversation)
+    # Only the new query is parsed, previous turns keep their extracted mentions
+    query_coref_resolved = coref.resolve(query_tokens(query), mentions_of)
+    conversation = coref.conversation() + '. ' + query + '.'
 
-    return (query, '')
+    return (query_coref_resolved.rstrip('.'), conversation)
+
+'''
+spaCy work, done in this process or sent to the NLP worker processes
+'''
+
+def analyze_query(question):
+    if nlp_service is not None:
+        return nlp_service.analyze_query(question)
+    return analyze_queries(nlp, [question])[0]
+
+def analyze_query_batch(questions):
+    if nlp_service is not None:
+        return nlp_service.analyze_queries(questions)
+    return analyze_queries(nlp, questions)
+
+def query_tokens(text):
+    if nlp_service is not None:
+        return nlp_service.query_tokens(text)
+    return doc_tokens(nlp['mentions'](text))
+
+def mentions_of(text):
+    if nlp_service is not None:
+        return nlp_service.extract_mentions(text)
+    return extract_mentions(nlp['mentions'](text))
+
+def coref_resolve(conversation):
+    if nlp_service is not None:
+        return nlp_service.coref_resolve(conversation)
+    return resolve_conversation(nlp['coref'], conversation)
+
+def text_vectors(texts):
+    if nlp_service is not None:
+        return nlp_service.vectors(texts)
+    return pipeline_vectors(nlp, texts)
 
 def get_answer(query, sessionID):
     query_coref_resolved, conversation = resolve_pronouns(query, sessionID)
@@ -264,21 +479,7 @@ def get_answer(query, sessionID):
 
     return (answer, query_coref_resolved, label, title, article, answer_qa, answer_chatbot, title_qa, article)
 
-def query_tokenizer(nlp):
-    inf = list(nlp.Defaults.infixes)               # Default infixes
-    inf.remove(r"(?<=[0-9])[+\-\*^](?=[0-9-])")    # Remove the generic op between numbers or between a number and a -
-    inf = tuple(inf)                               # Convert inf to tuple
-    infixes = inf + tuple([r"(?<=[0-9])[+*^](?=[0-9-])", r"(?<=[0-9])-(?=-)"])  # Add the removed rule after subtracting (?<=[0-9])-(?=[0-9]) pattern
-    infixes = [x for x in infixes if '-|–|—|--|---|——|~' not in x] # Remove - between letters rule
-    infix_re = compile_infix_regex(infixes)
-
-    return Tokenizer(nlp.vocab, prefix_search=nlp.tokenizer.prefix_search,
-                                suffix_search=nlp.tokenizer.suffix_search,
-                                infix_finditer=infix_re.finditer,
-                                token_match=nlp.tokenizer.token_match,
-                                rules=nlp.Defaults.tokenizer_exceptions)
-
-def get_query_from_question(question):
+def prepare_question(question):
     if os.getenv('StripStopWordsForES'):
         question = strip_stop_words(question)
 
@@ -291,43 +492,106 @@ def get_query_from_question(question):
     # remove double space
     question = re.sub(r"\s+", " ", question)
 
-    # nlp tokenizer ignore "-"
-    nlp.tokenizer = query_tokenizer(nlp)
-    question_nlp = nlp(question)
+    return question
+
+def build_query(question, question_tokens):
     query = ""
     maxQueryScore = 0
 
     #query build
-    for word in question_nlp:
-        if word.text != "":
-            # if word is a proper noun, a named entity, superlative or comparative, add it to the query
-            if word.pos_ == 'PROPN' or word.pos_ == 'ADJ' or word.pos_ == 'ADV' or word.ent_iob_ == 'B' or word.ent_iob_ == 'I':
-                query += word.text + "^" + str(os.getenv('ESMajorWordMultiplication')) + " "
-                maxQueryScore += int(os.getenv('ESMajorWordMultiplication'))
-            # if word is a noun or firstname, add it to the query
-            elif word.pos_ == 'NOUN' or word.pos_ == 'PRON':
-                query += word.text + "^" + str(os.getenv('ESMediumWordMultiplication')) + " "
-                maxQueryScore += int(os.getenv('ESMediumWordMultiplication'))
-            # add to query other words
-            else:
-                query += word.text + "^" + str(os.getenv('ESLowWordMultiplication')) + " "  
-                maxQueryScore += int(os.getenv('ESLowWordMultiplication'))
+    for text, pos, ent_iob in question_tokens:
+        if text != "":
+            # boost each word by the multiplication of its class (Major, Medium or Low)
+            multiplication = os.getenv('ES%sWordMultiplication' % word_class(pos, ent_iob))
+            query += text + "^" + str(multiplication) + " "
+            maxQueryScore += int(multiplication)
 
     return query, question, maxQueryScore
 
+def get_query_from_question(question):
+    question = prepare_question(question)
+    # the query pipeline's tokenizer ignores "-"
+    return build_query(question, analyze_query(question))
+
+def build_search(query):
+    if PASSAGE_INDEX:
+        # Only the fields needed by the reader are sent back
+        return Search(using=es, index=PASSAGE_INDEX).query('query_string', query=query,
+            fields=['title^'+str(os.getenv('ESBoostTitle')), 'text^'+str(os.getenv('ESBoostText'))]) \
+            .source(['title', 'text', 'position', 'store_row'])[0:int(os.getenv('ESMaxPassage'))]
+    return Search(using=es, index=ES_INDEX).query('query_string', query=query,
+        fields=['title^'+str(os.getenv('ESBoostTitle')), 'opening_text^'+str(os.getenv('ESBoostOpeningText')), 'text^'+str(os.getenv('ESBoostText'))])[0:int(os.getenv('ESNbDocument'))]
+
 def get_documents_from_elasticsearch(question):
     question = question.lower()
-    query, question, maxQueryScore = get_query_from_question(question)
+    passages = retrieve_passages([get_query_from_question(question)])[0]
+    if passages is None:
+        raise RuntimeError('Search failed for %r' % question)
+    return passages
 
-    es = Elasticsearch([ES_HOST], port=ES_PORT)
+def retrieve_passages(queries):
+    # query_string search of every (query, question, maxQueryScore) in one
+    # multi-search request, merged with the dense index when there is one.
+    # None for the questions whose search failed.
+    ms = MultiSearch(using=es, index=SEARCH_INDEX)
+    for query, _, _ in queries:
+        ms = ms.add(build_search(query))
+    responses = ms.execute(raise_on_error=False)
+
+    if dense_index is not None:
+        return fuse_dense_passages(queries, responses)
+
+    all_passages = []
+    for (query, question, maxQueryScore), response in zip(queries, responses):
+        try:
+            all_passages.append(get_passages_from_hits(response, question, query, maxQueryScore))
+        except Exception:
+            all_passages.append(None)
+    return all_passages
+
+def fuse_dense_passages(queries, responses):
+    # query_string hits and nearest passages of the dense index, merged by
+    # reciprocal rank fusion, the fused score replacing the Elasticsearch score.
+    # The dense passages missing from the hits are fetched in one request.
+    max_passages = int(os.getenv('ESMaxPassage'))
+    vectors = text_vectors([question for _, question, _ in queries])
+    hits, lexical, dense = {}, [], []
+    for response, vector in zip(responses, vectors):
+        try:
+            response_hits = list(response)
+        except Exception:
+            lexical.append(None)
+            dense.append(None)
+            continue
+        for hit in response_hits:
+            hits[hit.meta.id] = hit
+        lexical.append([hit.meta.id for hit in response_hits])
+        dense.append([dense_index.ids[row] for row, _ in dense_index.search(vector, max_passages)])
+
+    missing = list(set(passage_id for ids in dense if ids for passage_id in ids if passage_id not in hits))
+    if missing:
+        for hit in Search(using=es, index=PASSAGE_INDEX).filter('ids', values=missing) \
+                .source(['title', 'text', 'position', 'store_row'])[0:len(missing)].execute():
+            hits[hit.meta.id] = hit
+
+    all_passages = []
+    for lexical_ids, dense_ids in zip(lexical, dense):
+        if lexical_ids is None:
+            all_passages.append(None)
+            continue
+        fused = reciprocal_rank_fusion([lexical_ids, dense_ids], int(os.getenv('DenseFusionK')))
+        all_passages.append([(hits[passage_id].text, score, hits[passage_id].title, getattr(hits[passage_id], 'store_row', None))
+                             for passage_id, score in fused if passage_id in hits][:max_passages])
+    return all_passages
+
+def get_passages_from_hits(hits, question, query, maxQueryScore):
+    if PASSAGE_INDEX:
+        # The hits are already passages, sorted by score, with their row in the WordPiece store
+        return [(hit.text, hit.meta.score, hit.title, getattr(hit, 'store_row', None)) for hit in hits]
 
-    s = Search(using=es, index=ES_INDEX).query('query_string', query=query,
-        fields=['title^'+str(os.getenv('ESBoostTitle')), 'opening_text^'+str(os.getenv('ESBoostOpeningText')), 'text^'+str(os.getenv('ESBoostText'))])[0:int(os.getenv('ESNbDocument'))]
-        
-    response = s.execute()
     passages = []
 
-    for hit in response:
+    for hit in hits:
         scoreSentences = []
         
         sentences = nltk.sent_tokenize(hit.text)
@@ -365,50 +629,272 @@ def get_documents_from_elasticsearch(question):
     return passages
 
 
+def passage_wordpieces(passage):
+    # Stored WordPiece ids and alignment of a passage, None to tokenize it
+    if passage_store is None or len(passage) < 4 or passage[3] is None:
+        return None
+    return passage_store.get(passage[3])
+
+
+def rerank_passages(question, passages):
+    if reranker is None:
+        return passages
+    return reranker.rerank(question, passages)
+
+
+def normalize_question(question):
+    question = strip_punctuation(question.lower())
+    return re.sub(r"\s+", " ", question).strip()
+
+
+def get_index_version():
+    # The index version is checked at most every AnswerCacheVersionCheck seconds,
+    # re-indexing or bulk loading pages changes the uuid or the number of documents
+    now = time.time()
+    if now - index_version['checked'] >= int(os.getenv('AnswerCacheVersionCheck')):
+        settings = es.indices.get_settings(index=SEARCH_INDEX)
+        uuid = next(iter(settings.values()))['settings']['index']['uuid']
+        count = es.count(index=SEARCH_INDEX)['count']
+        index_version['value'] = (uuid, count)
+        index_version['checked'] = now
+    return index_version['value']
+
+
 def get_answer_from_question(question):
     '''
     Full query approach
     '''
-    
-    responses = []
+    return get_answers_from_questions([question])[0]
+
+
+@contextlib.contextmanager
+def timed_stage(timings, stage):
+    start = time.time()
     try:
-        passages = get_documents_from_elasticsearch(question)
-        for passage in passages:
-            responses.append((bert.get_answer(question, passage[0]), passage))
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.time() - start
+
+
+def get_answers_from_questions(questions, timings=None):
+    '''
+    Answers a batch of questions stage by stage, each stage running once for
+    all the questions still unanswered: answer cache, query analysis (one
+    nlp.pipe), semantic cache, title fast path, retrieval (one multi-search),
+    re-ranking, reading (BERT batches across the questions) and vote.
+    `timings` receives the seconds spent in each stage.
+    '''
+    timings = timings if timings is not None else collections.OrderedDict()
+    results = [None] * len(questions)
+    cache_keys = [None] * len(questions)
+    semantic_keys = [None] * len(questions)
+    pending = list(range(len(questions)))
+
+    with timed_stage(timings, 'cache'):
+        if answer_cache is not None and pending:
+            try:
+                answer_cache.set_version(get_index_version())
+                for i in pending:
+                    cache_keys[i] = (SEARCH_INDEX, normalize_question(questions[i]))
+                    results[i] = answer_cache.get(cache_keys[i])
+            except:
+                cache_keys = [None] * len(questions)
+        pending = [i for i in pending if results[i] is None]
+
+    try:
+        with timed_stage(timings, 'analysis'):
+            # the query pipeline's tokenizer ignores "-"
+            prepared = [prepare_question(questions[i].lower()) for i in pending]
+            analyses = dict(zip(pending, analyze_query_batch(prepared) if pending else []))
+            queries = { i: build_query(question, analyses[i]) for i, question in zip(pending, prepared) }
+
+        with timed_stage(timings, 'semantic_cache'):
+            if semantic_cache is not None and pending:
+                try:
+                    semantic_cache.set_version(get_index_version())
+                    vectors = text_vectors([normalize_question(questions[i]) for i in pending])
+                    for i, vector in zip(pending, vectors):
+                        semantic_keys[i] = (vector, semantic_guard(questions[i], analyses[i]))
+                        results[i] = semantic_cache.get(*semantic_keys[i])
+                        if results[i] is not None and cache_keys[i] is not None:
+                            answer_cache.put(cache_keys[i], results[i])
+                except:
+                    semantic_keys = [None] * len(questions)
+                pending = [i for i in pending if results[i] is None]
+
+        with timed_stage(timings, 'title'):
+            if title_index is not None and pending:
+                try:
+                    for i, result in zip(pending, answers_from_titles([questions[i] for i in pending])):
+                        if result is not None:
+                            results[i] = result
+                            cache_answer(cache_keys[i], semantic_keys[i], result)
+                except:
+                    pass
+                pending = [i for i in pending if results[i] is None]
+
+        with timed_stage(timings, 'retrieval'):
+            all_passages = dict(zip(pending, retrieve_passages([queries[i] for i in pending]) if pending else []))
+            for i in [i for i in pending if all_passages[i] is None]:
+                # Failed searches are not cached
+                results[i] = ('','','')
+            pending = [i for i in pending if results[i] is None]
+
+        with timed_stage(timings, 'rerank'):
+            for i in pending:
+                all_passages[i] = rerank_passages(questions[i], all_passages[i])
+
+        with timed_stage(timings, 'reader'):
+            all_responses = read_passages([questions[i] for i in pending], [all_passages[i] for i in pending])
     except:
-        return ('','','')
-    
-    # remove response that are egual to ""
-    responses = [r for r in responses if r[0] != ""]
-    if len(responses) == 0:
-        return ('','','')
-
-    scores = []
-    i = 0
-    while i < len(responses):        
-        response_i = " ".join([token.lemma_ for token in nlp(responses[i][0])])
-
-        score = 0
-        y = 0
-        while y < len(responses):
-            # compare responses with each other
-            if i != y:                     
-                response_y = " ".join([token.lemma_ for token in nlp(responses[y][0])])    
-                if response_i == response_y: 
-                    score += 1
-                    responses.remove(responses[y])
-                    y -= 1     
-            y += 1
-        scores.append(score)
-        i += 1
-
-    #return response with best score
-    currentBest = 0
-    for i in range(len(responses)):
-        if scores[i] > scores[currentBest]:
-            currentBest = i
-
-    return (responses[currentBest][0],responses[currentBest][1][2],responses[currentBest][1][0])
+        for i in pending:
+            results[i] = ('','','')
+        return results
+
+    with timed_stage(timings, 'vote'):
+        for i, responses in zip(pending, all_responses):
+            # remove response that are egual to ""
+            responses = [r for r in responses if r[0] != ""]
+            if len(responses) == 0:
+                results[i] = ('','','')
+            else:
+                best = vote_answers(responses)
+                results[i] = (best[0], best[1][2], best[1][0])
+            cache_answer(cache_keys[i], semantic_keys[i], results[i])
+
+    return results
+
+
+def read_passages(questions, all_passages):
+    # (answer, passage, probability) responses of each question, the pairs of
+    # all the questions being read by BERT together. With CascadeMode, the
+    # passages are read in rounds, the n-th passage of every question still
+    # reading in one batch, and a question stops at its first confident span.
+    all_responses = [[] for _ in questions]
+    if not os.getenv('CascadeMode'):
+        pairs = [(i, passage) for i, passages in enumerate(all_passages) for passage in passages]
+        predictions = bert.predict_batch([(questions[i], passage[0], passage_wordpieces(passage))
+                                          for i, passage in pairs]) if pairs else []
+        for (i, passage), prediction in zip(pairs, predictions):
+            all_responses[i].append((prediction.text, passage, prediction.probability))
+        return all_responses
+
+    for i, passages in enumerate(all_passages):
+        if not passages:
+            update_cascade_stats(0, 0)
+    reading = [i for i, passages in enumerate(all_passages) if passages]
+    position = 0
+    while reading:
+        predictions = bert.predict_batch([(questions[i], all_passages[i][position][0],
+                                           passage_wordpieces(all_passages[i][position])) for i in reading])
+        still_reading = []
+        for i, prediction in zip(reading, predictions):
+            passages, responses = all_passages[i], all_responses[i]
+            responses.append((prediction.text, passages[position], prediction.probability))
+            if position + 1 < len(passages) and is_confident(prediction):
+                update_cascade_stats(len(passages), position + 1)
+                all_responses[i] = [responses[-1]]
+            elif position + 1 < len(passages):
+                still_reading.append(i)
+            else:
+                update_cascade_stats(len(passages), len(passages))
+        reading = still_reading
+        position += 1
+    return all_responses
+
+
+def cache_answer(cache_key, semantic_key, result):
+    if cache_key is not None:
+        answer_cache.put(cache_key, result)
+    # A paraphrase is not served "no answer", it may be answered with other words
+    if semantic_key is not None and result[0] != '':
+        semantic_cache.put(semantic_key[0], result, semantic_key[1])
+
+
+def semantic_guard(question, tokens):
+    # Question word and key terms (nouns, numbers and the major words of the
+    # Elasticsearch query, from the analysis of the query), which must be the
+    # same for a paraphrase
+    question_word = next((word for word in re.findall(r"\w+", question.lower())
+                          if word in ['who', 'what', 'when', 'where', 'why', 'how', 'which']), None)
+    terms = frozenset(text.lower() for text, pos, ent_iob in tokens
+                      if pos in ['NOUN', 'NUM'] or word_class(pos, ent_iob) == 'Major')
+    return (question_word, terms)
+
+
+def answers_from_titles(questions):
+    # "What is X ?" where X is an article title or redirect: the opening text of
+    # that article is read by a single BERT pass instead of searching and reading
+    # several passages. None for the questions left to the full search.
+    page_ids = []
+    for question in questions:
+        subject = definition_subject(question)
+        page_ids.append(title_index.lookup(subject) if subject is not None else None)
+        if subject is not None:
+            with title_lock:
+                title_stats['questions'] += 1
+                title_stats['matches'] += int(page_ids[-1] is not None)
+
+    wanted = list(set(str(page_id) for page_id in page_ids if page_id is not None))
+    if not wanted:
+        return [None] * len(questions)
+    hits = { hit.meta.id: hit for hit in Search(using=es, index=ES_INDEX).filter('ids', values=wanted)
+             .source(['title', 'opening_text'])[0:len(wanted)].execute()
+             if getattr(hit, 'opening_text', None) }
+
+    readable = [i for i, page_id in enumerate(page_ids) if str(page_id) in hits]
+    predictions = bert.predict_batch([(questions[i], hits[str(page_ids[i])].opening_text) for i in readable]) \
+        if readable else []
+
+    results = [None] * len(questions)
+    for i, prediction in zip(readable, predictions):
+        if prediction.text != '':
+            hit = hits[str(page_ids[i])]
+            results[i] = (prediction.text, hit.title, hit.opening_text)
+            with title_lock:
+                title_stats['answers'] += 1
+    return results
+
+
+def is_confident(prediction):
+    # A span is confident when its probability, or its margin over the null
+    # answer (score_diff is the null score minus the best span score), is high enough
+    if prediction.text == '':
+        return False
+    if prediction.probability >= float(os.getenv('CascadeMinProbability')):
+        return True
+    return (prediction.score_diff is not None and
+            -prediction.score_diff >= float(os.getenv('CascadeMinNullMargin')))
+
+
+def update_cascade_stats(retrieved, read):
+    with cascade_lock:
+        cascade_stats['questions'] += 1
+        cascade_stats['early_exits'] += int(read < retrieved)
+        cascade_stats['passages_retrieved'] += retrieved
+        cascade_stats['passages_read'] += read
+
+
+def normalize_answer(answer):
+    # Lowercase, remove punctuation and articles, fold plural endings
+    answer = strip_punctuation(answer.lower())
+    words = [w[:-1] if len(w) > 3 and w.endswith('s') and not w.endswith('ss') else w
+             for w in answer.split()
+             if w not in ['a', 'an', 'the']]
+    return ' '.join(words)
+
+
+def vote_answers(responses):
+    # Group equivalent answers, each response being (answer, passage, probability).
+    # The group with the most votes wins, ties are broken by the sum of the BERT
+    # probabilities and then by the retrieval order of the passages.
+    groups = collections.OrderedDict()
+    for response in responses:
+        key = normalize_answer(response[0]) or response[0]
+        groups.setdefault(key, []).append(response)
+
+    best_group = max(groups.values(), key=lambda g: (len(g), sum(r[2] for r in g)))
+    return max(best_group, key=lambda r: r[2])
 
 
 def strip_stop_words(sentence):
@@ -429,3 +915,52 @@ def strip_punctuation(sentence):
     translator = str.maketrans('', '', string.punctuation)
     s_no_punctuation = sentence.translate(translator)
     return s_no_punctuation
+
+
+# Passage used by the warmup when Elasticsearch returns nothing
+WARMUP_PASSAGE = ('Penicillin was discovered in 1928 by Alexander Fleming, a Scottish scientist. '
+                  'It was one of the first antibiotics and is still widely used today.')
+
+def warmup():
+    # Runs representative queries through the chatbot, the controller, the
+    # retrieval, BERT and the pronoun resolution so that the one-time costs
+    # (torch allocations, first spaCy calls, Elasticsearch connection) are paid
+    # before taking traffic. Returns the time spent in each step.
+    timings = collections.OrderedDict()
+    errors = collections.OrderedDict()
+
+    def timed(step, function, *args):
+        start = time.time()
+        try:
+            return function(*args)
+        except Exception as e:
+            errors[step] = repr(e)
+        finally:
+            timings[step] = timings.get(step, 0.0) + time.time() - start
+
+    session = touch_session('warmup')
+    try:
+        for _ in range(int(os.getenv('WarmupRounds'))):
+            # Each round runs the full BERT pass instead of the answers cached by the previous one
+            bert.passage_cache.clear()
+            for query in os.getenv('WarmupQueries').split('|'):
+                timed('controller', controller.define_class, query)
+                timed('chatbot', chatbot.get_answer, query)
+                passages = timed('retrieval', get_documents_from_elasticsearch, query) or []
+                passage = passages[0][0] if passages else WARMUP_PASSAGE
+                wordpieces = passage_wordpieces(passages[0]) if passages else None
+                answer = timed('bert', bert.get_answer, query, passage, wordpieces) or ''
+                session['chat'].append({ 'label': 'QA', 'query_coref_resolved': query, 'answer': answer })
+                session['coref'].add_turn(query, answer)
+                timed('resolve_pronouns', resolve_pronouns, 'When was it discovered ?', 'warmup')
+    finally:
+        with sessions_lock:
+            sessions.pop('warmup', None)
+        # Warmup answers are not kept in the passage cache
+        bert.passage_cache.clear()
+
+    return { 'seconds': { step: round(t, 3) for step, t in timings.items() }, 'errors': errors }
+
+
+# Started last, the warmup uses the functions defined above
+startup.start(on_loaded, warmup if os.getenv('Warmup') else None)
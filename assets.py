@@ -0,0 +1,214 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import zipfile
+
+
+# Every model file used at runtime is listed in assets.json, with its path in the
+# repository and where to get it. `python assets.py bootstrap` puts them in place
+# once, the runtime loaders only read these local paths and never the network.
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MANIFEST = os.path.join(ROOT, 'assets.json')
+NLTK_DATA = os.path.join(ROOT, 'data', 'nltk_data')
+NEURALCOREF_CACHE = os.path.join(ROOT, 'data', 'neuralcoref')
+
+
+OPTS = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Install and verify the model files listed in assets.json.')
+
+    parser.add_argument('command', choices=['bootstrap', 'verify', 'lock'],
+                        help='bootstrap: fetch the missing assets and verify them, '
+                             'verify: check the checksums of the assets, '
+                             'lock: record the checksums of the installed assets in the manifest '
+                             '(only run it on copies known to be good).')
+
+    parser.add_argument('-s', '--source', dest='source',
+                        help='Local directory with the files (or archives) to copy instead of downloading them.')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    return parser.parse_args()
+
+
+def load_manifest(path=MANIFEST):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def asset_path(entry):
+    return os.path.join(ROOT, entry['path'])
+
+
+def checksum(path):
+    # Directories are hashed over their sorted relative paths and contents
+    sha256 = hashlib.sha256()
+    if os.path.isdir(path):
+        files = sorted(os.path.relpath(os.path.join(directory, name), path)
+                       for directory, _, names in os.walk(path) for name in names)
+    else:
+        files = [None]
+    for name in files:
+        if name is not None:
+            sha256.update(name.replace(os.sep, '/').encode('utf-8'))
+        with open(path if name is None else os.path.join(path, name), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(block)
+    return sha256.hexdigest()
+
+
+def require(*names):
+    """
+    Returns the local paths of the assets `names`, or raises FileNotFoundError
+    if any of them is missing. Only existence and size are checked here so that
+    startup stays fast, the checksums are verified by `bootstrap` and `verify`.
+    """
+    manifest = load_manifest()
+    paths, missing = [], []
+    for name in names:
+        entry = manifest[name]
+        path = asset_path(entry)
+        if not os.path.exists(path):
+            missing.append('{} ({})'.format(name, entry['path']))
+        elif entry.get('size') is not None and os.path.getsize(path) != entry['size']:
+            missing.append('{} ({}, size differs from the manifest)'.format(name, entry['path']))
+        paths.append(path)
+    if missing:
+        raise FileNotFoundError('Missing model assets: {}. Run "python assets.py bootstrap" first.'.format(
+            ', '.join(missing)))
+    return paths
+
+
+def download(url, destination):
+    import requests
+
+    print('Downloading ' + url)
+    with requests.get(url, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        with open(destination, 'wb') as f:
+            for block in r.iter_content(1 << 20):
+                f.write(block)
+
+
+def check_member(directory, name):
+    # Archive members are only extracted inside `directory`
+    root = os.path.realpath(directory)
+    target = os.path.realpath(os.path.join(directory, name))
+    if os.path.isabs(name) or (target != root and not target.startswith(root + os.sep)):
+        raise ValueError('Archive member outside of the destination: ' + name)
+
+
+def unpack(archive, directory):
+    os.makedirs(directory, exist_ok=True)
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as z:
+            for name in z.namelist():
+                check_member(directory, name)
+            z.extractall(directory)
+    else:
+        with tarfile.open(archive) as t:
+            members = t.getmembers()
+            for member in members:
+                check_member(directory, member.name)
+                if member.issym():
+                    check_member(directory, os.path.join(os.path.dirname(member.name), member.linkname))
+                elif member.islnk():
+                    check_member(directory, member.linkname)
+                elif not (member.isfile() or member.isdir()):
+                    raise ValueError('Unsupported archive member: ' + member.name)
+            t.extractall(directory, members=members)
+
+
+def install(entry, source):
+    # The fetched file, or the asset unpacked from it, only replaces the asset
+    # once its checksum matches the manifest
+    path = asset_path(entry)
+    # Name of the file looked for in the source directory
+    name = os.path.basename(entry['url'] if entry.get('unpack') and entry.get('url') else entry['path'])
+    with tempfile.TemporaryDirectory(dir=ROOT) as tmp:
+        fetched = os.path.join(tmp, name)
+        if source and os.path.exists(os.path.join(source, name)):
+            shutil.copyfile(os.path.join(source, name), fetched)
+        elif entry.get('url'):
+            download(entry['url'], fetched)
+        else:
+            return False
+        if entry.get('archive_sha256') and checksum(fetched) != entry['archive_sha256']:
+            print('{}: checksum of {} does not match the manifest, not unpacked'.format(entry['path'], name))
+            return False
+        if entry.get('unpack'):
+            unpack(fetched, os.path.join(tmp, 'unpacked'))
+            fetched = os.path.join(tmp, 'unpacked', os.path.relpath(path, os.path.join(ROOT, entry['unpack'])))
+        if not os.path.exists(fetched) or checksum(fetched) != entry['sha256']:
+            print('{}: checksum of {} does not match the manifest, not installed'.format(entry['path'], name))
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(fetched, path)
+    return True
+
+
+def verify(manifest):
+    # An asset without checksum in the manifest fails, it cannot be verified
+    ok = True
+    for name, entry in manifest.items():
+        path = asset_path(entry)
+        if not os.path.exists(path):
+            print('{:<20} missing'.format(name))
+            ok = False
+        elif entry.get('sha256') is None:
+            print('{:<20} NO CHECKSUM in the manifest, run "python assets.py lock" on a verified copy'.format(name))
+            ok = False
+        elif checksum(path) != entry['sha256']:
+            print('{:<20} CHECKSUM MISMATCH'.format(name))
+            ok = False
+        else:
+            print('{:<20} ok'.format(name))
+    return ok
+
+
+def main():
+    manifest = load_manifest()
+
+    if OPTS.command == 'lock':
+        for entry in manifest.values():
+            path = asset_path(entry)
+            if os.path.exists(path):
+                entry['sha256'] = checksum(path)
+                entry['size'] = None if os.path.isdir(path) else os.path.getsize(path)
+            # Archives found in --source are pinned too, to be checked before unpacking
+            if entry.get('unpack') and entry.get('url') and OPTS.source:
+                archive = os.path.join(OPTS.source, os.path.basename(entry['url']))
+                if os.path.exists(archive):
+                    entry['archive_sha256'] = checksum(archive)
+        with open(MANIFEST, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+            f.write('\n')
+        return
+
+    if OPTS.command == 'bootstrap':
+        for name, entry in manifest.items():
+            if os.path.exists(asset_path(entry)):
+                continue
+            if entry.get('sha256') is None:
+                print('{}: no checksum in the manifest, not downloaded'.format(name))
+                continue
+            if not install(entry, OPTS.source):
+                print('{}: download {} manually to {}'.format(name, entry.get('manual', '(no source)'), entry['path']))
+
+    if not verify(manifest):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    OPTS = parse_args()
+    main()
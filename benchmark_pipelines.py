@@ -0,0 +1,110 @@
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+
+from coref import extract_mentions
+from pipelines import PROFILES, load_pipelines, word_class
+
+
+OPTS = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare latency and accuracy of the spaCy pipeline profiles.')
+
+    parser.add_argument('-f', '--file', dest='file', required=True,
+                        help='File with one question per line.')
+
+    parser.add_argument('-p', '--profiles', dest='profiles', nargs='+',
+                        default=sorted(PROFILES), choices=sorted(PROFILES),
+                        help='Profiles to benchmark.')
+
+    parser.add_argument('-r', '--reference', dest='reference', default='full',
+                        choices=sorted(PROFILES),
+                        help='Profile used as reference for the accuracy.')
+
+    parser.add_argument('-n', '--max-questions', dest='max_questions', type=int, default=1000,
+                        help='Maximum number of questions to read.')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    return parser.parse_args()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_profile(profile, questions, queue):
+    # Runs in its own process so that load time and memory are not shared between profiles
+    start = time.time()
+    nlp = load_pipelines(profile, ['query', 'mentions'])
+    load_time = time.time() - start
+
+    query_times, query_classes = [], []
+    mention_times, mentions = [], []
+    for question in questions:
+        start = time.time()
+        doc = nlp['query'](question)
+        query_times.append(time.time() - start)
+        query_classes.append([(w.text, word_class(w.pos_, w.ent_iob_)) for w in doc])
+
+        start = time.time()
+        doc = nlp['mentions'](question)
+        mention_times.append(time.time() - start)
+        mentions.append(extract_mentions(doc))
+
+    queue.put({
+        'profile': profile,
+        'load_time': load_time,
+        # ru_maxrss is in kilobytes on Linux
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'query_times': query_times,
+        'query_classes': query_classes,
+        'mention_times': mention_times,
+        'mentions': mentions
+    })
+
+
+def main():
+    with open(OPTS.file, encoding='utf-8') as f:
+        questions = [line.strip() for line in f if line.strip()][:OPTS.max_questions]
+    if not questions:
+        sys.exit('No question found in ' + OPTS.file)
+
+    profiles = list(OPTS.profiles)
+    if OPTS.reference not in profiles:
+        profiles.insert(0, OPTS.reference)
+
+    results = {}
+    for profile in profiles:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_profile, args=(profile, questions, queue))
+        process.start()
+        results[profile] = queue.get()
+        process.join()
+
+    reference = results[OPTS.reference]
+    print('{:<8} {:>8} {:>9} {:>10} {:>10} {:>10} {:>10} {:>9} {:>9}'.format(
+        'profile', 'load(s)', 'rss(MB)', 'query p50', 'query p95',
+        'ment. p50', 'ment. p95', 'query acc', 'ment. acc'))
+    for profile in profiles:
+        r = results[profile]
+        query_acc = sum(a == b for a, b in zip(r['query_classes'], reference['query_classes']))
+        mention_acc = sum(a == b for a, b in zip(r['mentions'], reference['mentions']))
+        print('{:<8} {:>8.2f} {:>9.0f} {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms {:>9.3f} {:>9.3f}'.format(
+            profile, r['load_time'], r['max_rss_mb'],
+            percentile(r['query_times'], 0.5) * 1000, percentile(r['query_times'], 0.95) * 1000,
+            percentile(r['mention_times'], 0.5) * 1000, percentile(r['mention_times'], 0.95) * 1000,
+            query_acc / len(questions), mention_acc / len(questions)))
+
+
+if __name__ == '__main__':
+    OPTS = parse_args()
+    main()
@@ -18,6 +18,7 @@
 from __future__ import absolute_import, division, print_function
 
 import collections
+import hashlib
 import json
 import logging
 import math
@@ -33,12 +34,12 @@ from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
-from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+from cache import LRUCache
+from passage_store import split_doc_tokens
 from pytorch_pretrained_bert.modeling import BertForQuestionAnswering, BertConfig, WEIGHTS_NAME, CONFIG_NAME
-from pytorch_pretrained_bert.optimization import BertAdam, warmup_linear
 from pytorch_pretrained_bert.tokenization import (BasicTokenizer,
                                                   BertTokenizer,
-                                                  whitespace_tokenize)
+                                                  whitespace_tokenize, VOCAB_NAME)
 
 if sys.version_info[0] == 2:
     import cPickle as pickle
@@ -149,6 +150,10 @@ class Bert(object):
         self.LOSS_SCALE = 0
         self.VERSION_2_WITH_NEGATIVE = True
         self.NULL_SCORE_DIFF_THRESHOLD = 0.0
+        self.PASSAGE_CACHE_SIZE = 10000
+        self.PASSAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+        self.WORDPIECE_CACHE_SIZE = 200000
+        self.MAX_POSITION_EMBEDDINGS = 512
 
         if self.LOCAL_RANK == -1 or self.NO_CUDA:
             self.device = torch.device("cuda" if torch.cuda.is_available() and not self.NO_CUDA else "cpu")
@@ -191,66 +196,18 @@ class Bert(object):
         if not os.path.exists(self.OUTPUT_DIR):
             os.makedirs(self.OUTPUT_DIR)
 
-        self.tokenizer = BertTokenizer.from_pretrained(self.BERT_MODEL, do_lower_case=self.DO_LOWER_CASE)
-
-        train_examples = None
-        num_train_optimization_steps = None
-
-        # Prepare model
-        self.model = BertForQuestionAnswering.from_pretrained(self.BERT_MODEL,
-                    cache_dir=os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE), 'distributed_{}'.format(self.LOCAL_RANK)))
-
-        if self.FP16:
-            self.model.half()
-        self.model.to(self.device)
-        if self.LOCAL_RANK != -1:
-            try:
-                from apex.parallel import DistributedDataParallel as DDP
-            except ImportError:
-                raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use distributed and fp16 training.")
-
-            self.model = DDP(self.model)
-        elif n_gpu > 1:
-            self.model = torch.nn.DataParallel(self.model)
-
-        # Prepare optimizer
-        param_optimizer = list(self.model.named_parameters())
-
-        # hack to remove pooler, which is not used
-        # thus it produce None grad that break apex
-        param_optimizer = [n for n in param_optimizer if 'pooler' not in n[0]]
-
-        no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
-        optimizer_grouped_parameters = [
-            {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
-            {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
-            ]
-
-        if self.FP16:
-            try:
-                from apex.optimizers import FP16_Optimizer
-                from apex.optimizers import FusedAdam
-            except ImportError:
-                raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use distributed and fp16 training.")
-
-            optimizer = FusedAdam(optimizer_grouped_parameters,
-                                  lr=self.LEARNING_RATE,
-                                  bias_correction=False,
-                                  max_grad_norm=1.0)
-            if self.LOSS_SCALE == 0:
-                optimizer = self.FP16_Optimizer(optimizer, dynamic_loss_scale=True)
-            else:
-                optimizer = self.FP16_Optimizer(optimizer, static_loss_scale=self.LOSS_SCALE)
-        else:
-            optimizer = BertAdam(optimizer_grouped_parameters,
-                                 lr=self.LEARNING_RATE,
-                                 warmup=self.WARMUP_PROPORTION,
-                                 t_total=num_train_optimization_steps)
-
-        # self.model = BertForQuestionAnswering.from_pretrained(self.BERT_MODEL)
-
         output_model_file = os.path.join(self.OUTPUT_DIR, WEIGHTS_NAME)
         output_config_file = os.path.join(self.OUTPUT_DIR, CONFIG_NAME)
+        output_vocab_file = os.path.join(self.OUTPUT_DIR, VOCAB_NAME)
+
+        # Everything is read from OUTPUT_DIR (see assets.json), nothing is fetched
+        # from the remote cache of pytorch_pretrained_bert
+        for path in [output_model_file, output_config_file, output_vocab_file]:
+            if not os.path.exists(path):
+                raise FileNotFoundError("Missing BERT file {}, run \"python assets.py bootstrap\" first.".format(path))
+
+        self.tokenizer = BertTokenizer(output_vocab_file, do_lower_case=self.DO_LOWER_CASE,
+                                       max_len=self.MAX_POSITION_EMBEDDINGS)
 
         # Load a trained model and config that you have fine-tuned
         config = BertConfig(output_config_file)
@@ -261,6 +218,13 @@ class Bert(object):
             self.model.load_state_dict(torch.load(output_model_file, map_location='cpu'))
 
         self.model.to(self.device)
+
+        # Predictions of already seen (question, passage) pairs
+        self.passage_cache = LRUCache(self.PASSAGE_CACHE_SIZE,
+                                      max_bytes=self.PASSAGE_CACHE_MAX_BYTES)
+        # WordPiece tokens of already seen surface tokens
+        self.wordpiece_cache = {}
+
         print('\n*** QA MODULE READY [1/3] ***\n')
 
 
@@ -350,7 +314,7 @@ class Bert(object):
 
         features = []
         for (example_index, example) in enumerate(examples):
-            query_tokens = tokenizer.tokenize(example.question_text)
+            query_tokens = self._tokenize(tokenizer, example.question_text)
 
             if len(query_tokens) > max_query_length:
                 query_tokens = query_tokens[0:max_query_length]
@@ -358,12 +322,19 @@ class Bert(object):
             tok_to_orig_index = []
             orig_to_tok_index = []
             all_doc_tokens = []
-            for (i, token) in enumerate(example.doc_tokens):
-                orig_to_tok_index.append(len(all_doc_tokens))
-                sub_tokens = tokenizer.tokenize(token)
-                for sub_token in sub_tokens:
-                    tok_to_orig_index.append(i)
-                    all_doc_tokens.append(sub_token)
+            doc_wordpieces = getattr(example, "doc_wordpieces", None)
+            if doc_wordpieces is not None:
+                # Tokenized at ingestion time (see passage_store.py)
+                ids, tok_to_orig = doc_wordpieces
+                all_doc_tokens = [tokenizer.ids_to_tokens[i] for i in ids.tolist()]
+                tok_to_orig_index = tok_to_orig.tolist()
+            else:
+                for (i, token) in enumerate(example.doc_tokens):
+                    orig_to_tok_index.append(len(all_doc_tokens))
+                    sub_tokens = self._tokenize(tokenizer, token)
+                    for sub_token in sub_tokens:
+                        tok_to_orig_index.append(i)
+                        all_doc_tokens.append(sub_token)
 
             tok_start_position = None
             tok_end_position = None
@@ -399,6 +370,8 @@ class Bert(object):
                     break
                 start_offset += min(length, doc_stride)
 
+            max_context_spans = self._get_max_context_spans(doc_spans, len(all_doc_tokens))
+
             for (doc_span_index, doc_span) in enumerate(doc_spans):
                 tokens = []
                 token_to_orig_map = {}
@@ -416,9 +389,8 @@ class Bert(object):
                     split_token_index = doc_span.start + i
                     token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
 
-                    is_max_context = self._check_is_max_context(doc_spans, doc_span_index,
-                                                           split_token_index)
-                    token_is_max_context[len(tokens)] = is_max_context
+                    is_max_context = max_context_spans[split_token_index] == doc_span_index
+                    token_is_max_context[len(tokens)] = bool(is_max_context)
                     tokens.append(all_doc_tokens[split_token_index])
                     segment_ids.append(1)
                 tokens.append("[SEP]")
@@ -481,6 +453,20 @@ class Bert(object):
         return features
 
 
+    def _tokenize(self, tokenizer, text):
+        """WordPiece tokenization memoized per surface text for the model's tokenizer."""
+        if tokenizer is not getattr(self, "tokenizer", None):
+            return tokenizer.tokenize(text)
+
+        sub_tokens = self.wordpiece_cache.get(text)
+        if sub_tokens is None:
+            sub_tokens = tokenizer.tokenize(text)
+            if len(self.wordpiece_cache) >= self.WORDPIECE_CACHE_SIZE:
+                self.wordpiece_cache.clear()
+            self.wordpiece_cache[text] = sub_tokens
+        return sub_tokens
+
+
     def _improve_answer_span(self, doc_tokens, input_start, input_end, tokenizer,
                              orig_answer_text):
         """Returns tokenized answer spans that better match the annotated answer."""
@@ -555,9 +541,30 @@ class Bert(object):
         return cur_span_index == best_span_index
 
 
+    def _get_max_context_spans(self, doc_spans, num_tokens):
+        """Vectorized `_check_is_max_context`: the 'max context' span index of every token."""
+        if not doc_spans:
+            return np.zeros(0, dtype=np.int64)
+
+        starts = np.array([doc_span.start for doc_span in doc_spans], dtype=np.int64)
+        lengths = np.array([doc_span.length for doc_span in doc_spans], dtype=np.int64)
+        positions = np.arange(num_tokens, dtype=np.int64)
+
+        num_left_context = positions[None, :] - starts[:, None]
+        num_right_context = (starts + lengths - 1)[:, None] - positions[None, :]
+        scores = np.minimum(num_left_context, num_right_context) + 0.01 * lengths[:, None]
+        scores[(num_left_context < 0) | (num_right_context < 0)] = -np.inf
+
+        # argmax keeps the first best span, as the strict comparison of the loop does
+        return np.argmax(scores, axis=0)
+
+
     RawResult = collections.namedtuple("RawResult",
                                        ["unique_id", "start_logits", "end_logits"])
 
+    Prediction = collections.namedtuple("Prediction",
+                                        ["text", "probability", "score_diff", "nbest"])
+
 
     def write_predictions(self, all_examples, all_features, all_results, n_best_size,
                           max_answer_length, do_lower_case, output_prediction_file,
@@ -591,43 +598,25 @@ class Bert(object):
             null_end_logit = 0  # the end logit at the slice with min null score
             for (feature_index, feature) in enumerate(features):
                 result = unique_id_to_result[feature.unique_id]
-                start_indexes = self._get_best_indexes(result.start_logits, n_best_size)
-                end_indexes = self._get_best_indexes(result.end_logits, n_best_size)
+                start_logits = np.asarray(result.start_logits)
+                end_logits = np.asarray(result.end_logits)
                 # if we could have irrelevant answers, get the min score of irrelevant
                 if version_2_with_negative:
-                    feature_null_score = result.start_logits[0] + result.end_logits[0]
+                    feature_null_score = float(start_logits[0] + end_logits[0])
                     if feature_null_score < score_null:
                         score_null = feature_null_score
                         min_null_feature_index = feature_index
-                        null_start_logit = result.start_logits[0]
-                        null_end_logit = result.end_logits[0]
-                for start_index in start_indexes:
-                    for end_index in end_indexes:
-                        # We could hypothetically create invalid predictions, e.g., predict
-                        # that the start of the span is in the question. We throw out all
-                        # invalid predictions.
-                        if start_index >= len(feature.tokens):
-                            continue
-                        if end_index >= len(feature.tokens):
-                            continue
-                        if start_index not in feature.token_to_orig_map:
-                            continue
-                        if end_index not in feature.token_to_orig_map:
-                            continue
-                        if not feature.token_is_max_context.get(start_index, False):
-                            continue
-                        if end_index < start_index:
-                            continue
-                        length = end_index - start_index + 1
-                        if length > max_answer_length:
-                            continue
-                        prelim_predictions.append(
-                            _PrelimPrediction(
-                                feature_index=feature_index,
-                                start_index=start_index,
-                                end_index=end_index,
-                                start_logit=result.start_logits[start_index],
-                                end_logit=result.end_logits[end_index]))
+                        null_start_logit = float(start_logits[0])
+                        null_end_logit = float(end_logits[0])
+                for (start_index, end_index) in self._get_best_spans(
+                        feature, start_logits, end_logits, n_best_size, max_answer_length):
+                    prelim_predictions.append(
+                        _PrelimPrediction(
+                            feature_index=feature_index,
+                            start_index=start_index,
+                            end_index=end_index,
+                            start_logit=float(start_logits[start_index]),
+                            end_logit=float(end_logits[end_index])))
             if version_2_with_negative:
                 prelim_predictions.append(
                     _PrelimPrediction(
@@ -726,6 +715,7 @@ class Bert(object):
 
             if not version_2_with_negative:
                 all_predictions[example.qas_id] = nbest_json[0]["text"]
+                all_nbest_json[example.qas_id] = nbest_json
             else:
                 # predict "" iff the null score - the score of best non-null > threshold
                 score_diff = score_null - best_non_null_entry.start_logit - (
@@ -748,7 +738,18 @@ class Bert(object):
             with open(output_null_log_odds_file, "w") as writer:
                 writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
         '''
-        return all_predictions[example.qas_id]
+        predictions = collections.OrderedDict()
+        for (qas_id, text) in all_predictions.items():
+            probability = 0.0
+            for entry in all_nbest_json[qas_id]:
+                if entry["text"] == text:
+                    probability = entry["probability"]
+                    break
+            predictions[qas_id] = self.Prediction(text=text,
+                                                  probability=probability,
+                                                  score_diff=scores_diff_json.get(qas_id),
+                                                  nbest=all_nbest_json[qas_id])
+        return predictions
 
     def get_final_text(self, pred_text, orig_text, do_lower_case, verbose_logging=False):
         """Project the tokenized prediction back to the original text."""
@@ -858,6 +859,38 @@ class Bert(object):
         return best_indexes
 
 
+    def _get_best_spans(self, feature, start_logits, end_logits, n_best_size, max_answer_length):
+        """Get the n-best valid (start, end) spans of a feature, best first."""
+
+        # We throw out all invalid predictions at once, e.g. spans starting in the
+        # question or outside of the 'max context' doc span of their first token.
+        seq_length = min(len(start_logits), len(feature.tokens))
+        end_valid = np.zeros(seq_length, dtype=bool)
+        end_valid[[i for i in feature.token_to_orig_map if i < seq_length]] = True
+        start_valid = np.zeros(seq_length, dtype=bool)
+        start_valid[[i for (i, is_max_context) in feature.token_is_max_context.items()
+                     if is_max_context and i < seq_length]] = True
+        start_indexes = np.flatnonzero(start_valid & end_valid)
+        if len(start_indexes) == 0:
+            return []
+
+        # Band of the `max_answer_length` possible ends following every start
+        end_indexes = start_indexes[:, None] + np.arange(max_answer_length)[None, :]
+        in_range = end_indexes < seq_length
+        end_indexes = np.where(in_range, end_indexes, 0)
+        scores = start_logits[start_indexes][:, None] + end_logits[end_indexes]
+        scores = np.where(in_range & end_valid[end_indexes], scores, -np.inf).ravel()
+
+        k = min(n_best_size, int(np.isfinite(scores).sum()))
+        if k == 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+
+        rows, cols = np.unravel_index(best, end_indexes.shape)
+        return list(zip(start_indexes[rows].tolist(), end_indexes[rows, cols].tolist()))
+
+
     def _compute_softmax(self, scores):
         """Compute softmax probability over raw logits."""
         if not scores:
@@ -881,38 +914,71 @@ class Bert(object):
         return probs
 
 
-    def get_answer(self, question, article):
+    def get_answer(self, question, article, wordpieces=None):
+        prediction = self.predict(question, article, wordpieces)
+        if prediction is None:
+            return None
+        return prediction.text
+
+
+    def passage_key(self, question, doc_tokens):
+        """Hash of the question and the tokenized passage, used as passage cache key."""
+        # The raw question is used so that the key does not tokenize it again for every passage
+        key = question + "\n" + " ".join(doc_tokens)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+    def predict(self, question, article, wordpieces=None):
+        """Returns the `Prediction` of the model for a question over a passage."""
+        predictions = self.predict_batch([(question, article, wordpieces)])
+        if predictions is None:
+            return None
+        return predictions[0]
 
-        if self.DO_PREDICT and (self.LOCAL_RANK == -1 or torch.distributed.get_rank() == 0):
-            def is_whitespace(c):
-                if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F:
-                    return True
-                return False
-
-            doc_tokens = []
-            char_to_word_offset = []
-            prev_is_whitespace = True
-            for c in article:
-                if is_whitespace(c):
-                    prev_is_whitespace = True
-                else:
-                    if prev_is_whitespace:
-                        doc_tokens.append(c)
-                    else:
-                        doc_tokens[-1] += c
-                    prev_is_whitespace = False
-                char_to_word_offset.append(len(doc_tokens) - 1)
 
+    def predict_batch(self, pairs):
+        """
+        Returns the `Prediction`s for a list of (question, passage) pairs, run as one batch.
+        A pair can also be (question, passage, wordpieces), the WordPiece ids and
+        alignment of the passage read from a `PassageStore`, or None.
+        """
+
+        if self.DO_PREDICT and (self.LOCAL_RANK == -1 or torch.distributed.get_rank() == 0):
+            predictions = [None] * len(pairs)
+            cache_keys = {}
             eval_examples = []
-            example = SquadExample(
-                qas_id="1234",
-                question_text=question,
-                doc_tokens=doc_tokens,
-                orig_answer_text=None,
-                start_position=None,
-                end_position=None,
-                is_impossible=False)
-            eval_examples.append(example)
+            for (pair_index, pair) in enumerate(pairs):
+                question, article = pair[0], pair[1]
+                wordpieces = pair[2] if len(pair) > 2 else None
+                doc_tokens = split_doc_tokens(article)
+                if wordpieces is not None and len(wordpieces[1]) and int(wordpieces[1][-1]) >= len(doc_tokens):
+                    # Stored tokenization of another version of the passage
+                    wordpieces = None
+
+                if not doc_tokens:
+                    predictions[pair_index] = self.Prediction(text="", probability=0.0,
+                                                              score_diff=None, nbest=[])
+                    continue
+
+                cache_key = self.passage_key(question, doc_tokens)
+                predictions[pair_index] = self.passage_cache.get(cache_key)
+                if predictions[pair_index] is not None:
+                    continue
+                cache_keys[pair_index] = cache_key
+
+                example = SquadExample(
+                    qas_id=pair_index,
+                    question_text=question,
+                    doc_tokens=doc_tokens,
+                    orig_answer_text=None,
+                    start_position=None,
+                    end_position=None,
+                    is_impossible=False)
+                example.doc_wordpieces = wordpieces
+                eval_examples.append(example)
+
+            if not eval_examples:
+                return predictions
 
             eval_features = self.convert_examples_to_features(
                 examples=eval_examples,
@@ -940,8 +1006,8 @@ class Bert(object):
                 with torch.no_grad():
                     batch_start_logits, batch_end_logits = self.model(input_ids, segment_ids, input_mask)
                 for i, example_index in enumerate(example_indices):
-                    start_logits = batch_start_logits[i].detach().cpu().tolist()
-                    end_logits = batch_end_logits[i].detach().cpu().tolist()
+                    start_logits = batch_start_logits[i].detach().cpu().numpy()
+                    end_logits = batch_end_logits[i].detach().cpu().numpy()
                     eval_feature = eval_features[example_index.item()]
                     unique_id = int(eval_feature.unique_id)
                     all_results.append(self.RawResult(unique_id=unique_id,
@@ -953,9 +1019,13 @@ class Bert(object):
             output_nbest_file = os.path.join(self.OUTPUT_DIR, "nbest_predictions.json")
             output_null_log_odds_file = os.path.join(self.OUTPUT_DIR, "null_odds.json")
 
-            return self.write_predictions(eval_examples, eval_features, all_results,
+            new_predictions = self.write_predictions(eval_examples, eval_features, all_results,
                               self.N_BEST_SIZE, self.MAX_ANSWER_LENGTH,
                               self.DO_LOWER_CASE, output_prediction_file,
                               output_nbest_file, output_null_log_odds_file, self.VERBOSE_LOGGING,
                               self.VERSION_2_WITH_NEGATIVE, self.NULL_SCORE_DIFF_THRESHOLD)
+            for (pair_index, prediction) in new_predictions.items():
+                predictions[pair_index] = prediction
+                self.passage_cache.put(cache_keys[pair_index], prediction)
+            return predictions
 
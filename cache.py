@@ -0,0 +1,246 @@
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+
+from collections import OrderedDict
+
+
+# Version of the pickled AnswerCache state, files of another format are dropped
+CACHE_FORMAT = 2
+
+
+class LRUCache(object):
+    """
+    Thread-safe least-recently-used cache with an optional time-to-live.
+    Entries older than `ttl` seconds are treated as missing and dropped on access.
+    When `max_bytes` is given, `sizeof(value)` estimates the memory used by
+    each entry and the least recently used ones are evicted above the cap.
+    """
+
+    def __init__(self, max_entries, ttl=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or _pickled_size
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time(), value, size)
+            self._bytes += size
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.time() - entry[0] > self.ttl:
+            self._remove(key)
+            return None
+        return entry
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or \
+                (self.max_bytes is not None and self._bytes > self.max_bytes and self._entries):
+            self._bytes -= self._entries.popitem(last=False)[1][2]
+
+
+class AnswerCache(LRUCache):
+    """
+    Cache of final QA answers, tagged with the version of the index they were
+    computed against. Changing the version drops every entry. The cache can be
+    saved to and restored from a pickle file so it survives restarts.
+    """
+
+    def __init__(self, max_entries, ttl=None, path=None):
+        super(AnswerCache, self).__init__(max_entries, ttl)
+        self.path = path
+        self.version = None
+
+    def set_version(self, version):
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self._bytes = 0
+                self.version = version
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        if not isinstance(state, dict) or state.get('format') != CACHE_FORMAT:
+            # Saved by an older version, e.g. (time, value) entries without their size
+            os.remove(self.path)
+            return
+        with self._lock:
+            self.version = state['version']
+            self._entries = OrderedDict(state['entries'])
+            self._bytes = sum(entry[2] for entry in self._entries.values())
+            # Drop entries that expired while the application was down
+            for key in list(self._entries):
+                self._lookup(key)
+            self._evict()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            state = {
+                'format': CACHE_FORMAT,
+                'version': self.version,
+                'entries': list(self._entries.items())
+            }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+
+class SemanticCache(object):
+    """
+    Approximate answer cache for paraphrased questions. Each question is kept
+    with its unit-normalized vector in a fixed-size matrix searched by brute
+    force. A question is served the answer of the most similar cached one when
+    the cosine similarity reaches `threshold` and both have the same `guard`,
+    e.g. the question word and key terms, since "who is X" and "what is X" or
+    "what is X" and "what is Y" can have very close vectors. Above
+    `max_entries`, the least recently used slot is reused.
+    """
+
+    def __init__(self, max_entries, dimensions, threshold=0.95, ttl=None):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.similarity_sum = 0.0
+        self._vectors = np.zeros((max_entries, dimensions), dtype=np.float32)
+        self._used = np.zeros(max_entries, dtype=np.int64)
+        self._entries = [None] * max_entries
+        self._size = 0
+        self._clock = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._size
+
+    def set_version(self, version):
+        with self._lock:
+            if version != self.version:
+                self.clear()
+                self.version = version
+
+    def get(self, vector, guard=None, default=None):
+        vector = _unit(vector)
+        with self._lock:
+            if vector is not None and self._size:
+                similarities = self._vectors[:self._size].dot(vector)
+                now = time.time()
+                for slot in np.argsort(-similarities):
+                    if similarities[slot] < self.threshold:
+                        break
+                    created, entry_guard, value = self._entries[slot]
+                    if self.ttl is not None and now - created > self.ttl:
+                        continue
+                    if entry_guard == guard:
+                        self.hits += 1
+                        self.similarity_sum += float(similarities[slot])
+                        self._touch(slot)
+                        return value
+            self.misses += 1
+            return default
+
+    def put(self, vector, value, guard=None):
+        vector = _unit(vector)
+        if vector is None:
+            return
+        with self._lock:
+            if self._size < self.max_entries:
+                slot = self._size
+                self._size += 1
+            else:
+                slot = int(np.argmin(self._used))
+            self._vectors[slot] = vector
+            self._entries[slot] = (time.time(), guard, value)
+            self._touch(slot)
+
+    def clear(self):
+        with self._lock:
+            self._entries = [None] * self.max_entries
+            self._used[:] = 0
+            self._size = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'mean_hit_similarity': self.similarity_sum / self.hits if self.hits else None
+        }
+
+    def _touch(self, slot):
+        self._clock += 1
+        self._used[slot] = self._clock
+
+
+def _unit(vector):
+    # None for the zero vector of questions made of out-of-vocabulary words
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else None
+
+
+def _pickled_size(value):
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
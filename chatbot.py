@@ -5,6 +5,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import numpy as np
 import torch
 from torch.jit import script, trace
 import torch.nn as nn
@@ -21,6 +22,13 @@ import itertools
 import math
 import argparse
 import sys
+import json
+import threading
+import queue
+import time
+from array import array
+import torch.distributed as dist
+from distributed import average_gradients, broadcast_parameters, unique_parameters
 
 USE_CUDA = torch.cuda.is_available()
 device = torch.device("cuda" if USE_CUDA else "cpu")
@@ -78,6 +86,72 @@ class Voc:
         for word in keep_words:
             self.addWord(word)
 
+    # Compact vocabulary file, enough to run the model without the training corpus
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.__dict__, f)
+
+    def load(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            voc_dict = json.load(f)
+        # JSON object keys are strings
+        voc_dict['index2word'] = {int(k): v for k, v in voc_dict['index2word'].items()}
+        self.__dict__ = voc_dict
+
+# Slim inference checkpoints written by export_chatbot.py: a manifest.json describing
+# the tensors stored in one flat weights.bin file, and the vocabulary in voc.json
+def loadSlimCheckpoint(directory):
+    with open(os.path.join(directory, 'manifest.json'), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    # Copy-on-write mapping: the pages are shared by every process loading the
+    # same file as long as the weights are not modified
+    data = np.memmap(os.path.join(directory, 'weights.bin'), dtype=np.uint8, mode='c')
+
+    def read(offset, dtype, shape):
+        count = int(np.prod(shape))
+        nbytes = count * np.dtype(dtype).itemsize
+        return data[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    tensors = {}
+    for name, entry in manifest['tensors'].items():
+        array = read(entry['offset'], entry['dtype'], entry['shape'])
+        if entry['dtype'] == 'float32':
+            tensors[name] = torch.from_numpy(array)
+        elif entry['dtype'] == 'float16':
+            tensors[name] = torch.from_numpy(array.astype(np.float32))
+        elif entry['dtype'] == 'int8':
+            # Symmetric quantization with one scale per row
+            scales = read(entry['scale_offset'], 'float32', entry['shape'][:1])
+            scales = scales.reshape([-1] + [1] * (len(entry['shape']) - 1))
+            tensors[name] = torch.from_numpy(array.astype(np.float32) * scales)
+        else:
+            raise ValueError(entry['dtype'], "is not a supported checkpoint type.")
+    return manifest, tensors
+
+# Writes the slim checkpoint of a training checkpoint in a child process, so
+# that the memory of the whole training checkpoint is released with it
+def exportSlimCheckpoint(checkpoint_file, directory):
+    import multiprocessing
+    from export_chatbot import export
+
+    print('Exporting {} to {}'.format(checkpoint_file, directory))
+    process = multiprocessing.get_context('spawn').Process(target=export, args=(checkpoint_file, directory))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError('Exporting {} failed (exit code {})'.format(checkpoint_file, process.exitcode))
+
+# Use the loaded tensors as parameters of a module, without copying them
+def assignSlimTensors(module, prefix, tensors):
+    for name, _ in list(module.named_parameters()):
+        if prefix + name not in tensors:
+            continue
+        owner = module
+        path = name.split('.')
+        for attr in path[:-1]:
+            owner = getattr(owner, attr)
+        setattr(owner, path[-1], nn.Parameter(tensors[prefix + name], requires_grad=False))
+
 class EncoderRNN(nn.Module):
     def __init__(self, hidden_size, embedding, n_layers=1, dropout=0):
         super(EncoderRNN, self).__init__()
@@ -145,6 +219,19 @@ class Attn(nn.Module):
         # Return the softmax normalized probability scores (with added dimension)
         return F.softmax(attn_energies, dim=1).unsqueeze(1)
 
+    def forward_sequence(self, rnn_outputs, encoder_outputs):
+        # Attention weights of all the decoder steps at once: (batch, target_len, input_len)
+        if self.method == 'concat':
+            steps, length = rnn_outputs.size(0), encoder_outputs.size(0)
+            energy = self.attn(torch.cat((rnn_outputs.unsqueeze(1).expand(-1, length, -1, -1),
+                                          encoder_outputs.unsqueeze(0).expand(steps, -1, -1, -1)), 3)).tanh()
+            attn_energies = torch.sum(self.v * energy, dim=3).permute(2, 0, 1)
+        else:
+            keys = self.attn(encoder_outputs) if self.method == 'general' else encoder_outputs
+            attn_energies = torch.bmm(rnn_outputs.transpose(0, 1), keys.permute(1, 2, 0))
+
+        return F.softmax(attn_energies, dim=2)
+
 class LuongAttnDecoderRNN(nn.Module):
     def __init__(self, attn_model, embedding, hidden_size, output_size, n_layers=1, dropout=0.1):
         super(LuongAttnDecoderRNN, self).__init__()
@@ -187,6 +274,20 @@ class LuongAttnDecoderRNN(nn.Module):
         # Return output and final hidden state
         return output, hidden
 
+    def forward_sequence(self, input_seq, last_hidden, encoder_outputs):
+        # Note: with teacher forcing the inputs of all the steps are known, so
+        # the whole target is run through the GRU and the attention at once
+        embedded = self.embedding(input_seq)
+        embedded = self.embedding_dropout(embedded)
+        rnn_outputs, hidden = self.gru(embedded, last_hidden)
+        attn_weights = self.attn.forward_sequence(rnn_outputs, encoder_outputs)
+        context = attn_weights.bmm(encoder_outputs.transpose(0, 1)).transpose(0, 1)
+        concat_output = torch.tanh(self.concat(torch.cat((rnn_outputs, context), 2)))
+        output = self.out(concat_output)
+        # Log-probabilities of every step: (target_len, batch, vocabulary)
+        output = F.log_softmax(output, dim=2)
+        return output, hidden
+
 class GreedySearchDecoder(nn.Module):
     def __init__(self, encoder, decoder):
         super(GreedySearchDecoder, self).__init__()
@@ -224,7 +325,7 @@ class GreedySearchDecoder(nn.Module):
 
 class Chatbot:
 
-    def __init__(self, model_name, txt_file, checkpoint_iter):
+    def __init__(self, model_name, txt_file, checkpoint_iter, voc_file=None, slim_dir=None, **hyperparameters):
         # Hyperparameters
         self.formatted_movie_lines_file = txt_file
         self.max_length = 10
@@ -243,15 +344,33 @@ class Chatbot:
         self.learning_rate = 0.0001
         self.decoder_learning_ratio = 5.0
         self.n_iteration = 4000
+        self.stream_training_data = True
+        self.shuffle_buffer_size = 100000
+        self.prefetch_batches = 16
+        self.bucket_batches = True
+        self.vectorized_teacher_forcing = True
+        self.resume_training = False
         self.print_every = 1
         self.save_every = 500
+        # Data-parallel training (train.py): gradients are averaged between the
+        # processes and only the first one prints and saves checkpoints
+        self.world_size = 1
+        self.rank = 0
+
+        # Overrides of the hyperparameters above, e.g. do_training=True
+        for name, value in hyperparameters.items():
+            if not hasattr(self, name):
+                raise TypeError("Unknown chatbot hyperparameter: " + name)
+            setattr(self, name, value)
 
         USE_CUDA = torch.cuda.is_available()
-        self.device = torch.device("cuda" if USE_CUDA else "cpu")
+        # Data-parallel training runs on CPU processes
+        self.device = torch.device("cuda" if USE_CUDA and self.world_size == 1 else "cpu")
 
 
         # Define path to new file
         datafile = os.path.join("data", self.formatted_movie_lines_file)
+        self.datafile = datafile
         save_dir = os.path.join("data", "save")
 
         model_name = self.model_name
@@ -266,13 +385,37 @@ class Chatbot:
         loadFilename = None
         checkpoint = None
         checkpoint_iter = self.checkpoint_iter
+        slim_tensors = None
+
+        # The training corpus is only read when training, inference only needs
+        # the vocabulary stored in the checkpoint or in a separate vocabulary file
+        if self.do_training and self.stream_training_data:
+            # Pairs are read again from the corpus while training instead of kept in memory
+            self.voc, pairs = self.buildVocStream(self.model_name, datafile), None
+        elif self.do_training:
+            self.voc, pairs = self.loadPrepareData(self.model_name, datafile, save_dir)
+        else:
+            self.voc = Voc(self.model_name)
 
-        self.voc, pairs = self.loadPrepareData(self.model_name, datafile, save_dir)
+        checkpointFilename = os.path.join(save_dir, model_name,
+                                          '{}-{}_{}'.format(encoder_n_layers, decoder_n_layers, hidden_size),
+                                          '{}_checkpoint.tar'.format(checkpoint_iter))
 
         if not self.do_training:
-            loadFilename = os.path.join(save_dir, model_name,
-                                        '{}-{}_{}'.format(encoder_n_layers, decoder_n_layers, hidden_size),
-                                        '{}_checkpoint.tar'.format(checkpoint_iter))
+            # Inference always reads the slim checkpoint, the training checkpoint
+            # (with both optimizer states) is never deserialized in this process
+            slim_dir = slim_dir or os.path.join(os.path.dirname(checkpointFilename),
+                                                '{}_slim'.format(checkpoint_iter))
+            if not os.path.exists(os.path.join(slim_dir, 'manifest.json')):
+                exportSlimCheckpoint(checkpointFilename, slim_dir)
+            _, slim_tensors = loadSlimCheckpoint(slim_dir)
+            if voc_file and os.path.exists(voc_file):
+                self.voc.load(voc_file)
+            else:
+                self.voc.load(os.path.join(slim_dir, 'voc.json'))
+
+        elif self.resume_training:
+            loadFilename = checkpointFilename
             # If loading on same machine the model was trained on
             if torch.cuda.is_available():
                 checkpoint = torch.load(loadFilename)
@@ -282,10 +425,11 @@ class Chatbot:
             #checkpoint = torch.load(loadFilename, map_location=torch.device('cpu'))
             encoder_sd = checkpoint['en']
             decoder_sd = checkpoint['de']
-            encoder_optimizer_sd = checkpoint['en_opt']
-            decoder_optimizer_sd = checkpoint['de_opt']
             embedding_sd = checkpoint['embedding']
-            self.voc.__dict__ = checkpoint['voc_dict']
+            if voc_file and os.path.exists(voc_file):
+                self.voc.load(voc_file)
+            else:
+                self.voc.__dict__ = checkpoint['voc_dict']
 
         #print('Building encoder and decoder ...')
         # Initialize word embeddings
@@ -301,6 +445,11 @@ class Chatbot:
         if loadFilename:
             encoder.load_state_dict(encoder_sd)
             decoder.load_state_dict(decoder_sd)
+        elif slim_tensors:
+            # The embedding is shared by the encoder and the decoder and stored once
+            assignSlimTensors(embedding, 'embedding.', slim_tensors)
+            assignSlimTensors(encoder, 'encoder.', slim_tensors)
+            assignSlimTensors(decoder, 'decoder.', slim_tensors)
         # Use appropriate device
         self.encoder = encoder.to(self.device)
         self.decoder = decoder.to(self.device)
@@ -327,8 +476,8 @@ class Chatbot:
             encoder_optimizer = optim.Adam(encoder.parameters(), lr=learning_rate)
             decoder_optimizer = optim.Adam(decoder.parameters(), lr=learning_rate * decoder_learning_ratio)
             if loadFilename:
-                encoder_optimizer.load_state_dict(encoder_optimizer_sd)
-                decoder_optimizer.load_state_dict(decoder_optimizer_sd)
+                encoder_optimizer.load_state_dict(checkpoint['en_opt'])
+                decoder_optimizer.load_state_dict(checkpoint['de_opt'])
 
             # Run training iterations
             print("Starting Training!")
@@ -465,6 +614,118 @@ class Chatbot:
         #print("Counted words:", voc.num_words)
         return voc, pairs
 
+    # Reads normalized and filtered pairs from the corpus one line at a time
+    def streamPairs(self, datafile):
+        with open(datafile, 'r', encoding='utf-8') as f:
+            for line in f:
+                pair = [self.normalizeString(s) for s in line.split('\t')]
+                if self.filterPair(pair):
+                    yield pair
+
+    # Counts the words of the corpus without keeping its pairs
+    def buildVocStream(self, model_name, datafile):
+        voc = Voc(model_name)
+        for pair in self.streamPairs(datafile):
+            voc.addSentence(pair[0])
+            voc.addSentence(pair[1])
+        return voc
+
+    # Endless stream of shuffled pairs encoded as compact int arrays. The corpus
+    # is read again on each pass and shuffled through a bounded buffer.
+    def indexPair(self, voc, pair):
+        return (array('i', self.indexesFromSentence(voc, pair[0])),
+                array('i', self.indexesFromSentence(voc, pair[1])))
+
+    def streamIndexPairs(self, voc, datafile, buffer_size, rng=random):
+        buffer = []
+        while True:
+            n_pairs = 0
+            for pair in self.streamPairs(datafile):
+                n_pairs += 1
+                index_pair = self.indexPair(voc, pair)
+                if len(buffer) < buffer_size:
+                    buffer.append(index_pair)
+                    continue
+                i = rng.randrange(buffer_size)
+                yield buffer[i]
+                buffer[i] = index_pair
+            if n_pairs == 0:
+                raise ValueError("No training pair found in " + datafile)
+            rng.shuffle(buffer)
+            for index_pair in buffer:
+                yield index_pair
+            buffer = []
+
+    # Groups pairs with the same input and target lengths, so that batches need no padding
+    def bucketBatches(self, index_pairs, batch_size):
+        buckets = {}
+        for index_pair in index_pairs:
+            key = (len(index_pair[0]), len(index_pair[1]))
+            bucket = buckets.setdefault(key, [])
+            bucket.append(index_pair)
+            if len(bucket) == batch_size:
+                del buckets[key]
+                yield bucket
+
+    # Batches built on demand, from the corpus file when `pairs` is None. The
+    # sampling only depends on `seed`, so a run is resumed by skipping the
+    # `skip` batches it has already been trained on
+    def trainingBatches(self, voc, pairs, batch_size, seed=0, skip=0):
+        rng = random.Random(seed)
+        if pairs is not None:
+            index_pairs = (self.indexPair(voc, rng.choice(pairs)) for _ in itertools.count())
+        else:
+            index_pairs = self.streamIndexPairs(voc, self.datafile, self.shuffle_buffer_size, rng)
+        if self.bucket_batches:
+            index_batches = self.bucketBatches(index_pairs, batch_size)
+        else:
+            index_batches = (list(itertools.islice(index_pairs, batch_size)) for _ in itertools.count())
+        for _ in range(skip):
+            next(index_batches)
+        for index_batch in index_batches:
+            yield self.indexes2TrainData(index_batch)
+
+    # Builds the batches of `batches` in a background thread, `size` batches ahead.
+    # The end of the batches and the errors of the thread are sent through the
+    # queue, an error being raised again in the training loop. The thread stops
+    # once the training loop closes the generator.
+    def prefetch(self, batches, size):
+        prefetched = queue.Queue(maxsize=size)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    prefetched.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fill():
+            try:
+                for batch in batches:
+                    if not put((batch, None)):
+                        return
+            except Exception as e:
+                put((end, e))
+                return
+            put((end, None))
+
+        thread = threading.Thread(target=fill, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, error = prefetched.get()
+                if error is not None:
+                    raise error
+                if batch is end:
+                    return
+                yield batch
+        finally:
+            stop.set()
+
     def trimRareWords(self, voc, pairs, threshold_minimum):
         # Trim words used under the MIN_COUNT from the voc
         voc.trim(threshold_minimum)
@@ -530,6 +791,19 @@ class Chatbot:
         padVar = torch.LongTensor(padList)
         return padVar, mask, max_target_len
 
+    # Returns all items for a given batch of already indexed pairs
+    def indexes2TrainData(self, index_batch):
+        index_batch = sorted(index_batch, key=lambda x: len(x[0]), reverse=True)
+        input_batch = [list(pair[0]) for pair in index_batch]
+        output_batch = [list(pair[1]) for pair in index_batch]
+        lengths = torch.tensor([len(indexes) for indexes in input_batch])
+        inp = torch.LongTensor(self.zeroPadding(input_batch))
+        max_target_len = max([len(indexes) for indexes in output_batch])
+        padList = self.zeroPadding(output_batch)
+        mask = torch.ByteTensor(self.binaryMatrix(padList))
+        output = torch.LongTensor(padList)
+        return inp, lengths, output, mask, max_target_len
+
     # Returns all items for a given batch of pairs
     def batch2TrainData(self, voc, pair_batch):
         pair_batch.sort(key=lambda x: len(x[0].split(" ")), reverse=True)
@@ -580,8 +854,21 @@ class Chatbot:
         # Determine if we are using teacher forcing this iteration
         use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
 
+        if use_teacher_forcing and self.vectorized_teacher_forcing:
+            # Forward the whole batch of targets through the decoder at once, the
+            # inputs are the SOS tokens followed by the targets shifted by one step
+            decoder_inputs = torch.cat((decoder_input, target_variable[:-1]), 0)
+            decoder_output, decoder_hidden = decoder.forward_sequence(
+                decoder_inputs, decoder_hidden, encoder_outputs
+            )
+            crossEntropy = -torch.gather(decoder_output, 2, target_variable.unsqueeze(2)).squeeze(2)
+            mask = mask.float()
+            masked = crossEntropy * mask
+            # Same loss as the step-wise loop: sum over the steps of the mean over the batch
+            loss = (masked.sum(1) / mask.sum(1)).sum()
+            average_loss = masked.detach().sum() / mask.sum()
         # Forward batch of sequences through decoder one time step at a time
-        if use_teacher_forcing:
+        elif use_teacher_forcing:
             for t in range(max_target_len):
                 decoder_output, decoder_hidden = decoder(
                     decoder_input, decoder_hidden, encoder_outputs
@@ -607,10 +894,15 @@ class Chatbot:
                 loss += mask_loss
                 print_losses.append(mask_loss.item() * nTotal)
                 n_totals += nTotal
+            average_loss = sum(print_losses) / n_totals
 
         # Perform backpropatation
         loss.backward()
 
+        # Average the gradients of the batches of all the processes
+        if self.world_size > 1:
+            average_gradients(unique_parameters(encoder, decoder))
+
         # Clip gradients: gradients are modified in place
         _ = nn.utils.clip_grad_norm_(encoder.parameters(), clip)
         _ = nn.utils.clip_grad_norm_(decoder.parameters(), clip)
@@ -619,28 +911,42 @@ class Chatbot:
         encoder_optimizer.step()
         decoder_optimizer.step()
 
-        return sum(print_losses) / n_totals
+        # Single synchronization per batch with the vectorized path
+        return float(average_loss)
 
     def trainIters(self, model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer,
                 embedding, encoder_n_layers, decoder_n_layers, save_dir, n_iteration,
                 batch_size, print_every, save_every, clip, loadFilename,
                 teacher_forcing_ratio, hidden_size, max_length, checkpoint):
 
-        # Load batches for each iteration
-        training_batches = [self.batch2TrainData(voc, [random.choice(pairs) for _ in range(batch_size)])
-                            for _ in range(n_iteration)]
-
         # Initializations
         print('Initializing ...')
         start_iteration = 1
         print_loss = 0
+        print_time = time.time()
+        # Data loader state: the seed of the sampling and the number of batches already used
+        loader = { 'seed': random.randrange(2 ** 31), 'batches': 0 }
         if loadFilename:
             start_iteration = checkpoint['iteration'] + 1
+            loader = dict(checkpoint.get('loader', loader))
+        if self.world_size > 1:
+            # Same initial weights and loader seed in every process, each process
+            # then samples its own batches
+            broadcast_parameters(unique_parameters(encoder, decoder))
+            seed = torch.tensor([loader['seed']])
+            dist.broadcast(seed, 0)
+            loader['seed'] = int(seed[0])
+
+        # Batches are built on demand by a background thread instead of all up front
+        training_batches = self.prefetch(self.trainingBatches(voc, pairs, batch_size,
+                                                              loader['seed'] + self.rank, loader['batches']),
+                                         self.prefetch_batches)
 
         # Training loop
         print("Training...")
         for iteration in range(start_iteration, n_iteration + 1):
-            training_batch = training_batches[iteration - 1]
+            training_batch = next(training_batches)
+            loader['batches'] += 1
             # Extract fields from batch
             input_variable, lengths, target_variable, mask, max_target_len = training_batch
 
@@ -651,14 +957,17 @@ class Chatbot:
             print_loss += loss
 
             # Print progress
-            if iteration % print_every == 0:
+            if iteration % print_every == 0 and self.rank == 0:
                 print_loss_avg = print_loss / print_every
-                print("Iteration: {}; Percent complete: {:.1f}%; Average loss: {:.4f}"
-                    .format(iteration, iteration / n_iteration * 100, print_loss_avg))
+                pairs_per_second = print_every * batch_size * self.world_size / (time.time() - print_time)
+                print("Iteration: {}; Percent complete: {:.1f}%; Average loss: {:.4f}; Pairs/s: {:.0f}"
+                    .format(iteration, iteration / n_iteration * 100, print_loss_avg, pairs_per_second))
+            if iteration % print_every == 0:
                 print_loss = 0
+                print_time = time.time()
 
             # Save checkpoint
-            if (iteration % save_every == 0):
+            if (iteration % save_every == 0 or iteration == n_iteration) and self.rank == 0:
                 directory = os.path.join(save_dir, model_name,
                                         '{}-{}_{}'.format(encoder_n_layers, decoder_n_layers, hidden_size))
                 if not os.path.exists(directory):
@@ -671,8 +980,13 @@ class Chatbot:
                     'de_opt': decoder_optimizer.state_dict(),
                     'loss': loss,
                     'voc_dict': voc.__dict__,
-                    'embedding': embedding.state_dict()
+                    'embedding': embedding.state_dict(),
+                    'loader': dict(loader)
                 }, os.path.join(directory, '{}_{}.tar'.format(iteration, 'checkpoint')))
+                voc.save(os.path.join(directory, 'voc.json'))
+
+        # Stops the batch thread
+        training_batches.close()
 
     def evaluate(self, encoder, decoder, searcher, voc, sentence, max_length):
         ### Format input sentence as a batch
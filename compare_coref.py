@@ -0,0 +1,109 @@
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+from os.path import join, dirname
+
+from dotenv import load_dotenv
+
+from coref import PRONOUNS, CorefContext, doc_tokens, extract_mentions, resolve_conversation
+from pipelines import PROFILES, load_pipelines
+
+
+OPTS = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare the incremental pronoun resolution (IncrementalCoref) with '
+                    'neuralcoref on the conversations logged in dump/.')
+
+    parser.add_argument('-f', '--files', dest='files', nargs='+',
+                        default=sorted(glob.glob(join(dirname(__file__), 'dump', '*.json'))),
+                        help='JSON logs written by app.py (default: dump/*.json).')
+
+    parser.add_argument('-p', '--profile', dest='profile', default=os.getenv('SpacyProfile'),
+                        choices=sorted(PROFILES),
+                        help='spaCy profile (default: SpacyProfile of .env).')
+
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print the queries resolved differently.')
+
+    return parser.parse_args()
+
+
+def read_conversations(paths):
+    # Turns of each session in order. Logs written before the session id was
+    # added are read as one conversation per file.
+    conversations = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    conversations.setdefault(record.get('session', path), []).append(record)
+    return list(conversations.values())
+
+
+def contains_pronoun(query):
+    return any(word.lower() in PRONOUNS for word in re.findall(r"\w+", query))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def main():
+    conversations = read_conversations(OPTS.files)
+    if not conversations:
+        sys.exit('No conversation found in ' + ' '.join(OPTS.files))
+
+    nlp = load_pipelines(OPTS.profile, ['mentions', 'coref'])
+    mentions_of = lambda text: extract_mentions(nlp['mentions'](text))
+    max_turns = int(os.getenv('TemporalDistanceContext'))
+
+    compared = agreements = 0
+    full_times, incremental_times = [], []
+    for turns in conversations:
+        context = CorefContext(max_turns)
+        for turn in turns:
+            query = turn['query']
+            resolved = query
+            if context.turns and contains_pronoun(query):
+                # Same conversation as the neuralcoref path of app.py
+                start = time.time()
+                resolved = resolve_conversation(nlp['coref'], context.conversation() + '. ' + query + '.').rstrip('.')
+                full_times.append(time.time() - start)
+
+                start = time.time()
+                incremental = context.resolve(doc_tokens(nlp['mentions'](query)), mentions_of).rstrip('.')
+                incremental_times.append(time.time() - start)
+
+                compared += 1
+                if incremental.strip() == resolved.strip():
+                    agreements += 1
+                elif OPTS.verbose:
+                    print('{}\n  neuralcoref: {}\n  incremental: {}'.format(query, resolved, incremental))
+
+            # Both resolutions see the history resolved by neuralcoref
+            if turn.get('label_controller') == 'QA':
+                context.add_turn(resolved, turn['answer'])
+            else:
+                context.reset()
+
+    print('{} queries with a pronoun and a context, {} resolved the same way ({:.1%})'.format(
+        compared, agreements, agreements / compared if compared else 0.0))
+    print('neuralcoref p50 {:.1f}ms p95 {:.1f}ms, incremental p50 {:.1f}ms p95 {:.1f}ms'.format(
+        percentile(full_times, 0.5) * 1000, percentile(full_times, 0.95) * 1000,
+        percentile(incremental_times, 0.5) * 1000, percentile(incremental_times, 0.95) * 1000))
+
+
+if __name__ == '__main__':
+    load_dotenv(join(dirname(__file__), '.env'))
+    OPTS = parse_args()
+    main()
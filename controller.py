@@ -35,7 +35,7 @@ class BoWClassifier(nn.Module):  # inheriting from nn.Module!
 
 class Controller():
 
-    def __init__(self):
+    def __init__(self, load_model=True):
         torch.manual_seed(1)
 
         self.data = []
@@ -74,10 +74,24 @@ class Controller():
         self.label_to_ix = {"QA": 0, "CHAT": 1}
 
         self.model = BoWClassifier(NUM_LABELS, VOCAB_SIZE)
-        self.model.load_state_dict(torch.load(CONTROLLER_MODEL))
-        self.model.eval()
-
-        print('\n*** CONTROLLER READY [3/3] ***\n')
+        # The model is trained from scratch by train.py
+        if load_model:
+            self.model.load_state_dict(torch.load(CONTROLLER_MODEL))
+            self.model.eval()
+
+            print('\n*** CONTROLLER READY [3/3] ***\n')
+
+    def make_bow_vectors(self, sentences):
+        # One row of word counts per sentence (list of words)
+        vectors = torch.zeros(len(sentences), len(self.word_to_ix))
+        for i, sentence in enumerate(sentences):
+            for word in sentence:
+                if word in self.word_to_ix:
+                    vectors[i, self.word_to_ix[word]] += 1
+        return vectors
+
+    def make_targets(self, labels):
+        return torch.LongTensor([self.label_to_ix[label] for label in labels])
 
 
     def define_class(self, sentence):
@@ -0,0 +1,101 @@
+from collections import deque
+
+
+# Pronoun -> kind of antecedent it can refer to
+PRONOUNS = {
+    'he': 'person', 'him': 'person', 'his': 'person', 'himself': 'person',
+    'she': 'person', 'her': 'person', 'hers': 'person', 'herself': 'person',
+    'it': 'thing', 'its': 'thing', 'itself': 'thing',
+    'they': 'plural', 'them': 'plural', 'their': 'plural', 'theirs': 'plural',
+    'themselves': 'plural'
+}
+
+POSSESSIVES = ['his', 'hers', 'its', 'their', 'theirs']
+
+MAX_MENTION_LENGTH = 8
+
+
+def doc_tokens(doc):
+    # Compact (text, tag, trailing whitespace) representation of a parsed text
+    return [(token.text, token.tag_, token.whitespace_) for token in doc]
+
+
+def extract_mentions(doc):
+    # Compact (text, kind) list of the noun phrases of a parsed text, in order
+    person_tokens = set()
+    for ent in doc.ents:
+        if ent.label_ == 'PERSON':
+            person_tokens.update(range(ent.start, ent.end))
+
+    mentions = []
+    for chunk in doc.noun_chunks:
+        root = chunk.root
+        if root.pos_ == 'PRON' or root.text.lower() in PRONOUNS:
+            continue
+        # Keep the attachments of the head noun ("the capital of France")
+        span = doc[chunk.start:max(chunk.end, root.right_edge.i + 1)]
+        if len(span) > MAX_MENTION_LENGTH:
+            span = chunk
+        if root.i in person_tokens:
+            kind = 'person'
+        elif root.tag_ in ['NNS', 'NNPS']:
+            kind = 'plural'
+        else:
+            kind = 'thing'
+        mentions.append((span.text, kind))
+    return mentions
+
+
+def resolve_conversation(nlp, conversation):
+    # Full neuralcoref resolution, returns the last sentence of the resolved conversation
+    return resolve_conversations(nlp, [conversation])[0]
+
+
+def resolve_conversations(nlp, conversations, batch_size=64):
+    # Same as resolve_conversation for a batch, both passes going through nlp.pipe
+    resolved = [doc._.coref_resolved for doc in nlp.pipe(conversations, batch_size=batch_size)]
+    return [str(list(doc.sents)[-1]) for doc in nlp.pipe(resolved, batch_size=batch_size)]
+
+
+class CorefContext(object):
+    """
+    Coreference state of one session. It keeps the last QA turns together with
+    the noun phrases they mention, extracted at most once per turn, so that the
+    pronouns of a new query are resolved by parsing that query alone.
+    """
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)
+
+    def add_turn(self, query, answer):
+        self.turns.append({ 'query': query, 'answer': answer, 'mentions': None })
+
+    def reset(self):
+        self.turns.clear()
+
+    def conversation(self):
+        return '. '.join(turn['query'] + '. ' + turn['answer'] for turn in self.turns)
+
+    def antecedents(self, mentions_of):
+        # Most recent turn first, the mentions of a question before those of its answer
+        for turn in reversed(self.turns):
+            if turn['mentions'] is None:
+                turn['mentions'] = mentions_of(turn['query']) + mentions_of(turn['answer'])
+            for mention in turn['mentions']:
+                yield mention
+
+    def resolve(self, tokens, mentions_of):
+        # Replace each pronoun of the query by the closest compatible antecedent
+        resolved = ''
+        for text, tag, whitespace in tokens:
+            kind = PRONOUNS.get(text.lower())
+            if kind is not None:
+                for mention, mention_kind in self.antecedents(mentions_of):
+                    if mention_kind == kind:
+                        if tag == 'PRP$' or text.lower() in POSSESSIVES:
+                            text = mention + "'s"
+                        else:
+                            text = mention
+                        break
+            resolved += text + whitespace
+        return resolved.strip()
@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import sys
+
+from os.path import join, dirname
+
+import numpy as np
+from dotenv import load_dotenv
+
+
+# Dense retrieval over the passage index written by ingest_passages.py. Each
+# passage is embedded with the spaCy vectors of the query pipeline (average of
+# its word vectors, no model call) and the unit vectors are kept in a memory
+# mapped float16 matrix. An IVF/PQ index finds the candidates: the vectors are
+# clustered into `lists` with k-means, and the residual of each vector to its
+# centroid is product-quantized into one byte per subspace. The candidates of
+# the probed lists are then scored exactly against the mapped matrix.
+
+OPTS = None
+
+# Centroids of each product quantization subspace, one byte per code
+PQ_CENTROIDS = 256
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build the dense vector index of a passage index.')
+
+    parser.add_argument('-x', '--index', dest='index', default=os.getenv('PassageIndex'),
+                        help='Passage index (default: PassageIndex of .env).')
+
+    parser.add_argument('-o', '--output', dest='output', default=os.getenv('DenseIndex'),
+                        help='Output directory (default: DenseIndex of .env).')
+
+    parser.add_argument('-l', '--lists', dest='lists', type=int,
+                        help='Number of IVF lists (default: 4 * sqrt(passages)).')
+
+    parser.add_argument('-m', '--subspaces', dest='subspaces', type=int, default=30,
+                        help='Product quantization subspaces, must divide the vector size.')
+
+    parser.add_argument('-s', '--sample', dest='sample', type=int, default=100000,
+                        help='Vectors used to train the centroids.')
+
+    parser.add_argument('-n', '--iterations', dest='iterations', type=int, default=20,
+                        help='k-means iterations.')
+
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+                        help='Passages read from Elasticsearch and embedded at a time.')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    return parser.parse_args()
+
+
+def unit(vector):
+    # None for the zero vector of texts made of out-of-vocabulary words
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else None
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Merges rankings (lists of keys, best first) by summing 1 / (k + rank) over
+    the rankings each key appears in. Returns (key, score), best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class DenseIndex(object):
+    """
+    Read side of the index: `search(vector, k)` returns the (row, cosine) of
+    the `k` nearest passages, `ids[row]` being the id of the passage in the
+    passage index.
+    """
+
+    def __init__(self, directory, probes=8, candidates=50):
+        with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        with open(os.path.join(directory, 'ids.txt'), encoding='utf-8') as f:
+            self.ids = f.read().split('\n')[:self.manifest['passages']]
+        self.probes = probes
+        self.candidates = candidates
+
+        n, d, m = self.manifest['passages'], self.manifest['dimensions'], self.manifest['subspaces']
+        self.centroids = np.load(os.path.join(directory, 'centroids.npy'))
+        self.codebooks = np.load(os.path.join(directory, 'codebooks.npy'))
+        self.list_offsets = np.load(os.path.join(directory, 'list_offsets.npy'))
+        self.vectors = np.memmap(os.path.join(directory, 'vectors.bin'), dtype=np.float16, mode='r', shape=(n, d))
+        self.codes = np.memmap(os.path.join(directory, 'codes.bin'), dtype=np.uint8, mode='r', shape=(n, m))
+        self.rows = np.memmap(os.path.join(directory, 'rows.bin'), dtype=np.int64, mode='r', shape=(n,))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, vector, k):
+        query = unit(vector)
+        if query is None or not len(self.ids):
+            return []
+
+        m, pq_centroids, sub = self.codebooks.shape
+        distances = ((self.centroids - query) ** 2).sum(axis=1)
+        rows, approximations = [], []
+        for l in np.argsort(distances)[:self.probes]:
+            start, end = self.list_offsets[l], self.list_offsets[l + 1]
+            if start == end:
+                continue
+            # Distance of the query residual to every code of every subspace,
+            # the distance of a vector being the sum over its codes
+            residual = (query - self.centroids[l]).reshape(m, 1, sub)
+            tables = ((residual - self.codebooks) ** 2).sum(axis=2)
+            rows.append(self.rows[start:end])
+            approximations.append(tables[np.arange(m), self.codes[start:end]].sum(axis=1))
+        if not rows:
+            return []
+        rows, approximations = np.concatenate(rows), np.concatenate(approximations)
+
+        if len(rows) > self.candidates:
+            rows = rows[np.argpartition(approximations, self.candidates)[:self.candidates]]
+        # Sorted rows read the mapped matrix in order
+        rows = np.sort(rows)
+        scores = self.vectors[rows].astype(np.float32).dot(query)
+        order = np.argsort(-scores)[:k]
+        return [(int(rows[i]), float(scores[i])) for i in order]
+
+
+def nearest(data, centroids, chunk=65536):
+    # Index of the nearest centroid of each vector
+    norms = (centroids ** 2).sum(axis=1)
+    return np.concatenate([np.argmin(norms - 2 * data[i:i + chunk].dot(centroids.T), axis=1)
+                           for i in range(0, len(data), chunk)])
+
+
+def kmeans(data, k, iterations, rng):
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        counts = np.bincount(assignment, minlength=k)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Empty clusters restart from random vectors
+        centroids[empty] = data[rng.choice(len(data), int(empty.sum()))]
+    return centroids
+
+
+def read_passages(es, index, batch_size):
+    from elasticsearch.helpers import scan
+
+    for hit in scan(es, index=index, query={ '_source': ['text'] }, size=batch_size):
+        yield hit['_id'], hit['_source']['text']
+
+
+def embed_passages(es, tokenizer, path):
+    # Writes the unit vectors in row order and returns the ids of the rows
+    ids, batch = [], []
+    with open(path, 'wb') as f:
+        def flush():
+            for doc in tokenizer.pipe([text for _, text in batch], batch_size=OPTS.batch_size):
+                vector = unit(doc.vector)
+                f.write((vector if vector is not None else np.zeros(len(doc.vector), dtype=np.float32))
+                        .astype(np.float16).tobytes())
+            ids.extend(passage_id for passage_id, _ in batch)
+            del batch[:]
+
+        for passage in read_passages(es, OPTS.index, OPTS.batch_size):
+            batch.append(passage)
+            if len(batch) == OPTS.batch_size:
+                flush()
+                if len(ids) % 100000 == 0:
+                    print('{} passages embedded'.format(len(ids)), flush=True)
+        flush()
+    return ids
+
+
+def main():
+    from elasticsearch import Elasticsearch
+    from pipelines import PROFILES, load_pipelines
+
+    if not OPTS.index or not OPTS.output:
+        sys.exit('No passage index or output given (--index and --output or PassageIndex and DenseIndex in .env)')
+
+    model = os.getenv('SpacyQueryModel') or PROFILES[os.getenv('SpacyProfile')]['query']
+    nlp = load_pipelines(os.getenv('SpacyProfile'), ['query'], { 'query': model })['query']
+    d = nlp.vocab.vectors_length
+    if not d:
+        sys.exit('{} has no word vectors'.format(model))
+    if d % OPTS.subspaces:
+        sys.exit('{} subspaces do not divide vectors of size {}'.format(OPTS.subspaces, d))
+
+    os.makedirs(OPTS.output, exist_ok=True)
+    es = Elasticsearch([os.getenv('Host')], port=os.getenv('Port'), timeout=120)
+    ids = embed_passages(es, nlp.tokenizer, os.path.join(OPTS.output, 'vectors.bin'))
+    n, m = len(ids), OPTS.subspaces
+    if not n:
+        sys.exit('{} has no passages'.format(OPTS.index))
+    vectors = np.memmap(os.path.join(OPTS.output, 'vectors.bin'), dtype=np.float16, mode='r', shape=(n, d))
+
+    rng = np.random.RandomState(0)
+    lists = OPTS.lists or max(1, int(4 * np.sqrt(n)))
+    sample = vectors[np.sort(rng.choice(n, min(n, OPTS.sample), replace=False))].astype(np.float32)
+    centroids = kmeans(sample, lists, OPTS.iterations, rng)
+    residuals = (sample - centroids[nearest(sample, centroids)]).reshape(len(sample), m, d // m)
+    codebooks = np.stack([kmeans(residuals[:, j], PQ_CENTROIDS, OPTS.iterations, rng) for j in range(m)])
+    print('{} lists and {} x {} codes trained'.format(len(centroids), m, len(codebooks[0])), flush=True)
+
+    # Assign and encode all the vectors by chunks
+    assignment = np.empty(n, dtype=np.int64)
+    codes = np.empty((n, m), dtype=np.uint8)
+    for start in range(0, n, 65536):
+        chunk = vectors[start:start + 65536].astype(np.float32)
+        assignment[start:start + len(chunk)] = nearest(chunk, centroids)
+        residual = chunk - centroids[assignment[start:start + len(chunk)]]
+        for j in range(m):
+            codes[start:start + len(chunk), j] = nearest(residual[:, j * (d // m):(j + 1) * (d // m)], codebooks[j])
+
+    # Rows and codes are stored list after list
+    rows = np.argsort(assignment, kind='stable')
+    counts = np.bincount(assignment, minlength=len(centroids))
+    codes[rows].tofile(os.path.join(OPTS.output, 'codes.bin'))
+    rows.astype(np.int64).tofile(os.path.join(OPTS.output, 'rows.bin'))
+    np.save(os.path.join(OPTS.output, 'list_offsets.npy'), np.concatenate([[0], np.cumsum(counts)]))
+    np.save(os.path.join(OPTS.output, 'centroids.npy'), centroids)
+    np.save(os.path.join(OPTS.output, 'codebooks.npy'), codebooks)
+    with open(os.path.join(OPTS.output, 'ids.txt'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(ids))
+    with open(os.path.join(OPTS.output, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'format': 1,
+            'index': OPTS.index,
+            'model': model,
+            'passages': n,
+            'dimensions': d,
+            'lists': len(centroids),
+            'subspaces': m
+        }, f, indent=2)
+
+    print('{} passages of {} written to {} ({:.1f} MB)'.format(
+        n, OPTS.index, OPTS.output, n * (2 * d + m + 8) / (1024 * 1024)))
+
+
+if __name__ == '__main__':
+    load_dotenv(join(dirname(__file__), '.env'))
+    OPTS = parse_args()
+    main()
@@ -0,0 +1,44 @@
+import torch
+import torch.distributed as dist
+
+
+# Helpers for the data-parallel training of train.py: every process computes the
+# gradients of its own batch, which are then averaged before the optimizer step
+
+
+def init_process_group(rank, world_size, port):
+    # gloo works on CPU only nodes
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port,
+                            rank=rank, world_size=world_size)
+
+
+def unique_parameters(*modules):
+    # Shared parameters (e.g. the chatbot embedding) are only returned once
+    seen = set()
+    parameters = []
+    for module in modules:
+        for parameter in module.parameters():
+            if id(parameter) not in seen:
+                seen.add(id(parameter))
+                parameters.append(parameter)
+    return parameters
+
+
+def broadcast_parameters(parameters, src=0):
+    # Start every process from the weights of process `src`
+    for parameter in parameters:
+        dist.broadcast(parameter.data, src)
+
+
+def average_gradients(parameters):
+    # All the gradients are reduced in one flat buffer instead of one call per parameter
+    grads = [parameter.grad.data for parameter in parameters if parameter.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([grad.contiguous().view(-1) for grad in grads])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= dist.get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
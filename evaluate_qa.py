@@ -0,0 +1,260 @@
+import argparse
+import collections
+import json
+import os
+import re
+import string
+import sys
+import time
+
+from cache import LRUCache
+
+
+OPTS = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Bulk offline evaluation of the QA system, answering the questions '
+                    'the same way as the web application without its caches')
+
+    parser.add_argument('-i', '--input', dest='input', required=True,
+                        help='SQuAD json file, NDJSON log (dump/*.json) or text file with one question per line.')
+
+    parser.add_argument('-f', '--format', dest='format', default='auto',
+                        choices=['auto', 'squad', 'ndjson', 'text'],
+                        help='Format of the input file.')
+
+    parser.add_argument('-o', '--output', dest='output',
+                        help='NDJSON output file (default: stdout).')
+
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=32,
+                        help='Number of questions processed together.')
+
+    parser.add_argument('-n', '--limit', dest='limit', type=int,
+                        help='Maximum number of questions to evaluate.')
+
+    parser.add_argument('--cascade-audit', dest='cascade_audit', action='store_true',
+                        help='Answer every question with and without CascadeMode and compare '
+                             'the early exits with the full read.')
+
+    parser.add_argument('-t', '--startup-timeout', dest='startup_timeout', type=int, default=1800,
+                        help='Seconds to wait for the models to load.')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    return parser.parse_args()
+
+
+def read_questions(path, fmt):
+    # Yields dicts with the id, question and gold answers (None when unknown)
+    if fmt == 'auto':
+        if path.endswith('.txt'):
+            fmt = 'text'
+        else:
+            with open(path, encoding='utf-8') as f:
+                fmt = 'squad' if f.read(1) == '{' and '"data"' in f.read(1024) else 'ndjson'
+
+    if fmt == 'squad':
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)['data']
+        for entry in data:
+            for paragraph in entry['paragraphs']:
+                for qa in paragraph['qas']:
+                    answers = [a['text'] for a in qa['answers']]
+                    if qa.get('is_impossible') or not answers:
+                        answers = ['']
+                    yield { 'id': qa['id'], 'question': qa['question'], 'answers': answers }
+    else:
+        with open(path, encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                line = line.strip()
+                if not line:
+                    continue
+                if fmt == 'ndjson':
+                    record = json.loads(line)
+                    question = record.get('query_coref_resolved') or record.get('query') or record['question']
+                    answers = record.get('answers')
+                else:
+                    question = line
+                    answers = None
+                yield { 'id': str(i), 'question': question, 'answers': answers }
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def normalize_squad_answer(s):
+    # Same normalization as the official SQuAD evaluation script
+    s = s.lower()
+    s = ''.join(ch for ch in s if ch not in set(string.punctuation))
+    s = re.sub(r'\b(a|an|the)\b', ' ', s)
+    return ' '.join(s.split())
+
+
+def f1_score(prediction, gold):
+    prediction_tokens = normalize_squad_answer(prediction).split()
+    gold_tokens = normalize_squad_answer(gold).split()
+    if not prediction_tokens or not gold_tokens:
+        return float(prediction_tokens == gold_tokens)
+    common = collections.Counter(prediction_tokens) & collections.Counter(gold_tokens)
+    num_same = sum(common.values())
+    if num_same == 0:
+        return 0.0
+    precision = num_same / len(prediction_tokens)
+    recall = num_same / len(gold_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+def answers_with_cascade(qa, questions, enabled, timings=None):
+    # CascadeMode is read from the environment at each call
+    previous = os.environ.pop('CascadeMode', None)
+    if enabled:
+        os.environ['CascadeMode'] = previous or 'True'
+    try:
+        return qa.get_answers_from_questions(questions, timings)
+    finally:
+        os.environ.pop('CascadeMode', None)
+        if previous is not None:
+            os.environ['CascadeMode'] = previous
+
+
+def exact_match_score(prediction, gold):
+    return float(normalize_squad_answer(prediction) == normalize_squad_answer(gold))
+
+
+def evaluate_batch(qa, batch, cascade_audit=False):
+    # The batch goes through the staged pipeline of the web application: query
+    # analysis with nlp.pipe, one multi-search, title fast path, dense fusion,
+    # re-ranking, BERT batches across the questions, cascade and vote. The
+    # cascade audit reads every passage for the answer and records the early
+    # exit answer next to it.
+    questions = [q['question'] for q in batch]
+    timings = collections.OrderedDict()
+    if cascade_audit:
+        answers = answers_with_cascade(qa, questions, False, timings)
+        cascade_answers = answers_with_cascade(qa, questions, True)
+    else:
+        answers = qa.get_answers_from_questions(questions, timings)
+
+    records = []
+    for i, (q, (answer, title, _)) in enumerate(zip(batch, answers)):
+        record = collections.OrderedDict()
+        record['id'] = q['id']
+        record['question'] = q['question']
+        record['answer'] = answer
+        record['title'] = title
+        if cascade_audit:
+            record['cascade_answer'] = cascade_answers[i][0]
+            record['cascade_agreement'] = exact_match_score(cascade_answers[i][0], answer)
+        if q['answers'] is not None:
+            record['gold'] = q['answers']
+            record['exact_match'] = max(exact_match_score(answer, g) for g in q['answers'])
+            record['f1'] = max(f1_score(answer, g) for g in q['answers'])
+            if cascade_audit:
+                record['cascade_exact_match'] = max(exact_match_score(record['cascade_answer'], g)
+                                                    for g in q['answers'])
+                record['cascade_f1'] = max(f1_score(record['cascade_answer'], g) for g in q['answers'])
+        records.append(record)
+
+    # Stage timings are shared equally by the questions of the batch
+    for record in records:
+        record['timings'] = collections.OrderedDict(
+            (stage, duration / len(batch)) for stage, duration in timings.items())
+    return records, timings
+
+
+def disable_caches(qa):
+    # Every question is answered from scratch
+    qa.answer_cache = None
+    qa.semantic_cache = None
+    qa.bert.passage_cache = LRUCache(0)
+
+
+def wait_for_startup(startup, timeout):
+    # interrupt_main may not reach this thread while it waits, the loader
+    # error is polled instead
+    deadline = time.time() + timeout
+    try:
+        while not startup.wait(1):
+            if startup.error is not None:
+                break
+            if time.time() > deadline:
+                sys.exit('The models are not loaded after {}s'.format(timeout))
+    except KeyboardInterrupt:
+        if startup.error is None:
+            raise
+    if startup.error is not None:
+        sys.exit('Loading the models failed: {!r}'.format(startup.error))
+
+
+def main():
+    # Loads the models and the configuration of the web application
+    import app as qa
+    wait_for_startup(qa.startup, OPTS.startup_timeout)
+    disable_caches(qa)
+
+    output = open(OPTS.output, 'w', encoding='utf-8') if OPTS.output else sys.stdout
+
+    questions = read_questions(OPTS.input, OPTS.format)
+    if OPTS.limit:
+        questions = (q for i, q in zip(range(OPTS.limit), questions))
+
+    total = 0
+    exact_match = f1 = 0.0
+    scored = 0
+    cascade = collections.Counter()
+    stage_totals = collections.OrderedDict()
+    start = time.time()
+    for batch in batches(questions, OPTS.batch_size):
+        records, timings = evaluate_batch(qa, batch, OPTS.cascade_audit)
+        for record in records:
+            output.write(json.dumps(record) + '\n')
+            if 'f1' in record:
+                exact_match += record['exact_match']
+                f1 += record['f1']
+                scored += 1
+            for key in ['cascade_agreement', 'cascade_exact_match', 'cascade_f1']:
+                cascade[key] += record.get(key, 0.0)
+        output.flush()
+        for stage, duration in timings.items():
+            stage_totals[stage] = stage_totals.get(stage, 0.0) + duration
+        total += len(batch)
+
+    elapsed = time.time() - start
+    if output is not sys.stdout:
+        output.close()
+
+    print('Questions: {} in {:.1f}s ({:.2f} questions/s)'.format(
+        total, elapsed, total / elapsed if elapsed else 0.0), file=sys.stderr)
+    for stage, duration in stage_totals.items():
+        print('  {}: {:.1f}s'.format(stage, duration), file=sys.stderr)
+    if qa.title_index is not None:
+        print('  title fast path: {}'.format(dict(qa.title_stats)), file=sys.stderr)
+    if scored:
+        print('Exact match: {:.2f}, F1: {:.2f}'.format(
+            100 * exact_match / scored, 100 * f1 / scored), file=sys.stderr)
+    if OPTS.cascade_audit and total:
+        stats = qa.cascade_stats
+        print('Cascade: same answer as the full read for {:.1%} of the questions, {}/{} passages read'.format(
+            cascade['cascade_agreement'] / total, stats['passages_read'], stats['passages_retrieved']),
+            file=sys.stderr)
+        if scored:
+            print('Cascade exact match: {:.2f}, F1: {:.2f}'.format(
+                100 * cascade['cascade_exact_match'] / scored, 100 * cascade['cascade_f1'] / scored),
+                file=sys.stderr)
+
+
+if __name__ == '__main__':
+    OPTS = parse_args()
+    main()
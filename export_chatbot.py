@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import torch
+
+
+OPTS = None
+
+# Offsets of the tensors in weights.bin are aligned for memory mapping
+ALIGNMENT = 64
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Export a chatbot training checkpoint to a slim, memory-mappable inference format.')
+
+    parser.add_argument('-c', '--checkpoint', dest='checkpoint', required=True,
+                        help='Training checkpoint, e.g. data/save/bnc_cornell/2-2_500/8000_checkpoint.tar')
+
+    parser.add_argument('-o', '--output', dest='output', required=True,
+                        help='Output directory, e.g. data/save/bnc_cornell/2-2_500/slim')
+
+    parser.add_argument('-d', '--dtype', dest='dtype', default='float32',
+                        choices=['float32', 'float16', 'int8'],
+                        help='Storage type of the weights. float32 weights are used directly from '
+                             'the mapped file and shared between workers, float16 and int8 weights '
+                             'are smaller on disk but expanded to float32 in memory when loaded.')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    return parser.parse_args()
+
+
+def quantize(array):
+    # Symmetric int8 quantization with one scale per row
+    rows = array.reshape(array.shape[0], -1)
+    scales = np.abs(rows).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(rows / scales[:, None]).clip(-127, 127).astype(np.int8)
+    return quantized.reshape(array.shape), scales.astype(np.float32)
+
+
+def export(checkpoint_path, output, dtype='float32'):
+    """
+    Writes the slim checkpoint of a training checkpoint to the directory
+    `output`. It is written next to it first and renamed when complete, so
+    that a directory with a manifest is always a whole checkpoint.
+    """
+    final_output, output = output, output.rstrip(os.sep) + '.tmp'
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+
+    # Optimizer states and loss are dropped, the embedding shared by the encoder
+    # and the decoder is only stored once
+    tensors = [('embedding.weight', checkpoint['embedding']['weight'])]
+    for prefix, key in [('encoder.', 'en'), ('decoder.', 'de')]:
+        for name, tensor in checkpoint[key].items():
+            if name != 'embedding.weight':
+                tensors.append((prefix + name, tensor))
+
+    os.makedirs(output, exist_ok=True)
+
+    manifest = { 'format': 1, 'iteration': checkpoint.get('iteration'), 'tensors': {} }
+    offset = 0
+    with open(os.path.join(output, 'weights.bin'), 'wb') as f:
+        def write(array):
+            nonlocal offset
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            start = offset
+            data = np.ascontiguousarray(array).tobytes()
+            f.write(data)
+            offset += len(data)
+            return start
+
+        for name, tensor in tensors:
+            array = tensor.detach().cpu().float().numpy()
+            entry = { 'shape': list(array.shape) }
+            # Biases and other 1-dimension tensors are small, only matrices are quantized
+            if dtype == 'int8' and array.ndim >= 2:
+                quantized, scales = quantize(array)
+                entry['dtype'] = 'int8'
+                entry['offset'] = write(quantized)
+                entry['scale_offset'] = write(scales)
+            elif dtype == 'float16':
+                entry['dtype'] = 'float16'
+                entry['offset'] = write(array.astype(np.float16))
+            else:
+                entry['dtype'] = 'float32'
+                entry['offset'] = write(array)
+            manifest['tensors'][name] = entry
+
+    with open(os.path.join(output, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    with open(os.path.join(output, 'voc.json'), 'w', encoding='utf-8') as f:
+        json.dump(checkpoint['voc_dict'], f)
+
+    if os.path.exists(final_output):
+        shutil.rmtree(final_output)
+    os.rename(output, final_output)
+
+    print('Exported {} tensors ({:.1f} MB) to {}'.format(
+        len(tensors), offset / (1024 * 1024), final_output))
+
+
+def main():
+    export(OPTS.checkpoint, OPTS.output, OPTS.dtype)
+
+
+if __name__ == '__main__':
+    OPTS = parse_args()
+    main()
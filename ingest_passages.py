@@ -0,0 +1,168 @@
+import argparse
+import gzip
+import json
+import os
+import sys
+
+from os.path import join, dirname
+
+import nltk
+from dotenv import load_dotenv
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+
+from assets import NLTK_DATA, require
+from passage_store import PassageStoreWriter
+
+
+OPTS = None
+
+MAPPING = {
+    'mappings': {
+        '_doc': {
+            'properties': {
+                'title': { 'type': 'text' },
+                'text': { 'type': 'text' },
+                'page_id': { 'type': 'keyword' },
+                'position': { 'type': 'integer' },
+                # Row of the passage in the WordPiece store, not searched
+                'store_row': { 'type': 'integer', 'index': False }
+            }
+        }
+    }
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Index a CirrusSearch dump as overlapping passages, one document per passage.')
+
+    parser.add_argument('-i', '--input', dest='input', required=True,
+                        help='CirrusSearch dump, e.g. simplewiki-20190114-cirrussearch-content.json.gz')
+
+    parser.add_argument('-x', '--index', dest='index', default=os.getenv('PassageIndex'),
+                        help='Passage index (default: PassageIndex of .env).')
+
+    parser.add_argument('-l', '--length', dest='length', type=int, default=int(os.getenv('PassageLength')),
+                        help='Sentences per passage (default: PassageLength of .env).')
+
+    parser.add_argument('-s', '--stride', dest='stride', type=int,
+                        help='Sentences between the starts of two passages (default: length - 1, '
+                             'i.e. one sentence of overlap).')
+
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+                        help='Passages per bulk request.')
+
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=4,
+                        help='Number of bulk requests sent at the same time.')
+
+    parser.add_argument('-w', '--wordpiece-store', dest='store',
+                        help='Directory of the WordPiece store written next to the index (see PassageStore in .env).')
+
+    parser.add_argument('--recreate', action='store_true',
+                        help='Delete the passage index first if it exists.')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    return parser.parse_args()
+
+
+def read_pages(path):
+    # The dump alternates bulk action lines and page lines
+    f = gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, encoding='utf-8')
+    with f:
+        page_id = None
+        for line in f:
+            record = json.loads(line)
+            if 'index' in record:
+                page_id = record['index'].get('_id')
+                continue
+            if record.get('text') and record.get('title'):
+                yield page_id, record
+
+
+def passage_positions(n, length, stride):
+    # First sentence of each window, the last window ending on the last sentence
+    # even when the stride does not land on it
+    last = max(0, n - length)
+    positions = list(range(0, last + 1, stride))
+    if positions[-1] != last:
+        positions.append(last)
+    return positions
+
+
+def split_passages(text, length, stride):
+    sentences = nltk.sent_tokenize(text)
+    for position in passage_positions(len(sentences), length, stride):
+        yield position, ' '.join(sentences[position:position + length])
+
+
+def passage_actions(pages, index, length, stride, store=None):
+    for page_id, page in pages:
+        for position, text in split_passages(page['text'], length, stride):
+            source = {
+                'title': page['title'],
+                'text': text,
+                'page_id': page_id,
+                'position': position
+            }
+            if store is not None:
+                source['store_row'] = store.add(text)
+            yield {
+                '_index': index,
+                '_type': '_doc',
+                '_id': '{}-{}'.format(page_id, position),
+                '_source': source
+            }
+
+
+def wordpiece_store(directory):
+    # Same tokenizer as the reader of bert.py
+    from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+    vocab_file, = require('bert_vocab')
+    return PassageStoreWriter(directory, BertTokenizer(vocab_file, do_lower_case=True), do_lower_case=True)
+
+
+def main():
+    if not OPTS.index:
+        sys.exit('No passage index given (--index or PassageIndex in .env)')
+    if OPTS.store and not OPTS.recreate:
+        sys.exit('--wordpiece-store rewrites the store, it needs --recreate')
+
+    require('nltk_punkt')
+    nltk.data.path.insert(0, NLTK_DATA)
+
+    es = Elasticsearch([os.getenv('Host')], port=os.getenv('Port'), timeout=120)
+    if OPTS.recreate and es.indices.exists(index=OPTS.index):
+        es.indices.delete(index=OPTS.index)
+    if not es.indices.exists(index=OPTS.index):
+        es.indices.create(index=OPTS.index, body=MAPPING)
+
+    store = wordpiece_store(OPTS.store) if OPTS.store else None
+    stride = OPTS.stride or max(1, OPTS.length - 1)
+    actions = passage_actions(read_pages(OPTS.input), OPTS.index, OPTS.length, stride, store)
+
+    indexed = failed = 0
+    for ok, info in parallel_bulk(es, actions, thread_count=OPTS.threads,
+                                  chunk_size=OPTS.batch_size, raise_on_error=False):
+        if ok:
+            indexed += 1
+        else:
+            failed += 1
+            print(info, file=sys.stderr)
+        if (indexed + failed) % 100000 == 0:
+            print('{} passages indexed, {} failed'.format(indexed, failed), flush=True)
+
+    if store is not None:
+        store.close()
+    es.indices.refresh(index=OPTS.index)
+    print('{} passages indexed in {}, {} failed'.format(indexed, OPTS.index, failed))
+
+
+if __name__ == '__main__':
+    load_dotenv(join(dirname(__file__), '.env'))
+    OPTS = parse_args()
+    main()
@@ -0,0 +1,185 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from coref import doc_tokens, extract_mentions, resolve_conversations
+from pipelines import load_pipelines
+
+
+# Pipelines of a worker process, loaded once by `_init_worker`, or the
+# traceback of the load error raised by `_ready`
+_nlp = None
+_error = None
+_barrier = None
+
+
+def _init_worker(profile, roles, overrides, barrier):
+    global _nlp, _error, _barrier
+    _barrier = barrier
+    try:
+        _nlp = load_pipelines(profile, roles, overrides)
+    except Exception:
+        # An initializer error breaks the pool without its message
+        _error = traceback.format_exc()
+
+
+def _ready():
+    # Sent once per worker: each call waits on the barrier, so no worker can
+    # take two of them and every initializer has run when they all return
+    if _error is not None:
+        _barrier.abort()
+        raise RuntimeError('spaCy worker {} failed to load:\n{}'.format(os.getpid(), _error))
+    _barrier.wait()
+    return os.getpid()
+
+
+def analyze_queries(nlp, questions, batch_size=64):
+    # Compact (text, pos, ent_iob) tokens of each question
+    return [[(word.text, word.pos_, word.ent_iob_) for word in doc]
+            for doc in nlp['query'].pipe(questions, batch_size=batch_size)]
+
+
+def _analyze_queries(questions):
+    return analyze_queries(_nlp, questions)
+
+
+def _query_tokens(texts):
+    return [doc_tokens(doc) for doc in _nlp['mentions'].pipe(texts)]
+
+
+def _extract_mentions(texts):
+    return [extract_mentions(doc) for doc in _nlp['mentions'].pipe(texts)]
+
+
+def text_vectors(nlp, texts, batch_size=64):
+    # Average word vectors, which only need the tokenizer and not the tagger or NER
+    return [doc.vector for doc in nlp['query'].tokenizer.pipe(texts, batch_size=batch_size)]
+
+
+def _vectors(texts):
+    return text_vectors(_nlp, texts)
+
+
+def _vectors_length():
+    return _nlp['query'].vocab.vectors_length
+
+
+def _coref_resolve(conversations):
+    return resolve_conversations(_nlp['coref'], conversations)
+
+
+class _Batcher(object):
+    """
+    Groups the calls made from concurrent threads into batches sent to the
+    process pool. A batch is dispatched when it is full or when its first call
+    has waited `wait` seconds.
+    """
+
+    def __init__(self, executor, function, batch_size, wait):
+        self.executor = executor
+        self.function = function
+        self.batch_size = batch_size
+        self.wait = wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                result = self.executor.submit(self.function, [item for item, _ in batch])
+            except Exception as e:
+                self._distribute(batch, None, e)
+                continue
+            result.add_done_callback(lambda f, batch=batch: self._distribute(batch, f))
+
+    def _distribute(self, batch, result, error=None):
+        if error is None:
+            error = result.exception()
+        for i, (_, future) in enumerate(batch):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result.result()[i])
+
+
+class NlpService(object):
+    """
+    Runs the spaCy/neuralcoref work in a pool of worker processes, each with
+    its own copy of the pipelines, so that parsing does not hold the GIL of
+    the web server. Results are sent back as plain lists and strings instead
+    of `Doc` objects.
+    """
+
+    def __init__(self, processes, profile, roles, overrides=None, batch_size=16, wait=0.005):
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(processes)
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                                            initializer=_init_worker,
+                                            initargs=(profile, roles, overrides, barrier))
+        self.pids = self._wait_for_workers(processes, barrier)
+        self.batchers = {
+            'analyze_query': _Batcher(self.executor, _analyze_queries, batch_size, wait),
+            'query_tokens': _Batcher(self.executor, _query_tokens, batch_size, wait),
+            'extract_mentions': _Batcher(self.executor, _extract_mentions, batch_size, wait),
+            'coref_resolve': _Batcher(self.executor, _coref_resolve, batch_size, wait)
+        }
+
+    def _wait_for_workers(self, processes, barrier):
+        # Returns once every worker has loaded its pipelines, so that the
+        # caller sees the real load time, or raises the load error
+        futures = [self.executor.submit(_ready) for _ in range(processes)]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            barrier.abort()
+            self.executor.shutdown(wait=False)
+            # The load error rather than the broken barrier of the other workers
+            raise next((e for e in errors if isinstance(e, RuntimeError)), errors[0])
+        return [f.result() for f in futures]
+
+    def analyze_query(self, question):
+        return self.batchers['analyze_query'].submit(question).result()
+
+    def analyze_queries(self, questions):
+        # Bulk callers send their own batch in one call
+        return self.executor.submit(_analyze_queries, list(questions)).result()
+
+    def query_tokens(self, text):
+        return self.batchers['query_tokens'].submit(text).result()
+
+    def extract_mentions(self, text):
+        return self.batchers['extract_mentions'].submit(text).result()
+
+    def vectors(self, texts):
+        # One vector per text, sent as one batch
+        return self.executor.submit(_vectors, list(texts)).result()
+
+    def vectors_length(self):
+        # Width of the word vectors of the query model, 0 if it has none
+        return self.executor.submit(_vectors_length).result()
+
+    def coref_resolve(self, conversation):
+        return self.batchers['coref_resolve'].submit(conversation).result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,89 @@
+import json
+import os
+import re
+
+import numpy as np
+
+
+# Sidecar store of the WordPiece tokenization of the indexed passages, written by
+# ingest_passages.py. For each passage (row), the WordPiece ids and the index of
+# the whitespace token each of them comes from are stored in two flat files,
+# read through memory maps so that the reader does not tokenize at request time.
+
+# Same whitespace characters as the SQuAD reader of bert.py
+DOC_WHITESPACE = re.compile('[ \t\r\n\u202f]+')
+
+
+def split_doc_tokens(text):
+    return [token for token in DOC_WHITESPACE.split(text) if token]
+
+
+def wordpiece_alignment(tokenizer, doc_tokens):
+    # WordPiece ids of the passage and the doc token of each of them
+    ids, tok_to_orig = [], []
+    for (i, token) in enumerate(doc_tokens):
+        sub_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(token))
+        ids.extend(sub_ids)
+        tok_to_orig.extend([i] * len(sub_ids))
+    return ids, tok_to_orig
+
+
+class PassageStoreWriter(object):
+
+    def __init__(self, directory, tokenizer, do_lower_case=True):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.tokenizer = tokenizer
+        self.do_lower_case = do_lower_case
+        self.ids = open(os.path.join(directory, 'ids.bin'), 'wb')
+        self.orig = open(os.path.join(directory, 'orig.bin'), 'wb')
+        self.offsets = [0]
+
+    def add(self, text):
+        """Appends the tokenization of a passage and returns its row."""
+        ids, tok_to_orig = wordpiece_alignment(self.tokenizer, split_doc_tokens(text))
+        # The BERT vocabulary fits in 16 bits, passages are far below 65536 tokens
+        self.ids.write(np.asarray(ids, dtype=np.uint16).tobytes())
+        self.orig.write(np.asarray(tok_to_orig, dtype=np.uint16).tobytes())
+        self.offsets.append(self.offsets[-1] + len(ids))
+        return len(self.offsets) - 2
+
+    def close(self):
+        self.ids.close()
+        self.orig.close()
+        np.asarray(self.offsets, dtype=np.int64).tofile(os.path.join(self.directory, 'offsets.bin'))
+        with open(os.path.join(self.directory, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'format': 1,
+                'passages': len(self.offsets) - 1,
+                'vocab_size': len(self.tokenizer.vocab),
+                'do_lower_case': self.do_lower_case
+            }, f, indent=2)
+
+
+class PassageStore(object):
+    """
+    Read side of the store: `get(row)` returns the WordPiece ids and the
+    token alignment of a passage as numpy views on the mapped files.
+    """
+
+    def __init__(self, directory, vocab_size=None):
+        with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if vocab_size is not None and self.manifest['vocab_size'] != vocab_size:
+            raise ValueError("Passage store {} was built with another vocabulary ({} words instead of {})".format(
+                directory, self.manifest['vocab_size'], vocab_size))
+        self.offsets = np.fromfile(os.path.join(directory, 'offsets.bin'), dtype=np.int64)
+        if self.offsets[-1] == 0:
+            # numpy cannot map empty files
+            self.ids = self.orig = np.zeros(0, dtype=np.uint16)
+        else:
+            self.ids = np.memmap(os.path.join(directory, 'ids.bin'), dtype=np.uint16, mode='r')
+            self.orig = np.memmap(os.path.join(directory, 'orig.bin'), dtype=np.uint16, mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, row):
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.ids[start:end], self.orig[start:end]
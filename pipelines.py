@@ -0,0 +1,108 @@
+import os
+
+import spacy
+
+from assets import NEURALCOREF_CACHE, require
+from spacy.tokenizer import Tokenizer
+from spacy.util import compile_infix_regex
+
+
+# Components each code path needs from a spaCy pipeline
+ROLES = {
+    'query': ['tagger', 'ner'],                         # POS/NER based query weighting
+    'mentions': ['tagger', 'parser', 'ner'],            # noun phrases for incremental coref
+    'coref': ['tagger', 'parser', 'ner', 'neuralcoref'] # full neuralcoref resolution
+}
+
+# Model used by each role, chosen with SpacyProfile in .env
+PROFILES = {
+    'full': { 'query': 'en_core_web_lg', 'mentions': 'en_core_web_lg', 'coref': 'en_core_web_lg' },
+    'medium': { 'query': 'en_core_web_md', 'mentions': 'en_core_web_md', 'coref': 'en_core_web_md' },
+    'small': { 'query': 'en_core_web_sm', 'mentions': 'en_core_web_sm', 'coref': 'en_core_web_sm' },
+    'slim': { 'query': 'en_core_web_sm', 'mentions': 'en_core_web_md', 'coref': 'en_core_web_md' }
+}
+
+
+class Pipeline(object):
+    """
+    View on a loaded spaCy model that only runs the components of one role.
+    The components are called explicitly instead of using `nlp.disable_pipes`,
+    so several roles can share one model from concurrent threads.
+    """
+
+    def __init__(self, nlp, components, tokenizer=None):
+        self.nlp = nlp
+        self.components = components
+        self.tokenizer = tokenizer or nlp.tokenizer
+        self.vocab = nlp.vocab
+
+    def __call__(self, text):
+        doc = self.tokenizer(text)
+        for name, proc in self.nlp.pipeline:
+            if name in self.components:
+                doc = proc(doc)
+        return doc
+
+    def pipe(self, texts, batch_size=64):
+        docs = (self.tokenizer(text) for text in texts)
+        for name, proc in self.nlp.pipeline:
+            if name in self.components:
+                if hasattr(proc, 'pipe'):
+                    docs = proc.pipe(docs, batch_size=batch_size)
+                else:
+                    docs = (proc(doc) for doc in docs)
+        return docs
+
+
+def query_tokenizer(nlp):
+    inf = list(nlp.Defaults.infixes)               # Default infixes
+    inf.remove(r"(?<=[0-9])[+\-\*^](?=[0-9-])")    # Remove the generic op between numbers or between a number and a -
+    inf = tuple(inf)                               # Convert inf to tuple
+    infixes = inf + tuple([r"(?<=[0-9])[+*^](?=[0-9-])", r"(?<=[0-9])-(?=-)"])  # Add the removed rule after subtracting (?<=[0-9])-(?=[0-9]) pattern
+    infixes = [x for x in infixes if '-|–|—|--|---|——|~' not in x] # Remove - between letters rule
+    infix_re = compile_infix_regex(infixes)
+
+    return Tokenizer(nlp.vocab, prefix_search=nlp.tokenizer.prefix_search,
+                                suffix_search=nlp.tokenizer.suffix_search,
+                                infix_finditer=infix_re.finditer,
+                                token_match=nlp.tokenizer.token_match,
+                                rules=nlp.Defaults.tokenizer_exceptions)
+
+
+def word_class(pos, ent_iob):
+    # Weight class of a query word: proper nouns, named entities, superlatives
+    # and comparatives are major, nouns and pronouns medium, other words low
+    if pos == 'PROPN' or pos == 'ADJ' or pos == 'ADV' or ent_iob == 'B' or ent_iob == 'I':
+        return 'Major'
+    elif pos == 'NOUN' or pos == 'PRON':
+        return 'Medium'
+    return 'Low'
+
+
+def load_pipelines(profile, roles, overrides=None):
+    # Load every model needed by the roles once, without the components none of them use
+    models = dict(PROFILES[profile])
+    models.update(overrides or {})
+
+    needed = {}
+    for role in roles:
+        needed.setdefault(models[role], set()).update(ROLES[role])
+
+    loaded = {}
+    for name, components in needed.items():
+        nlp = spacy.load(name, disable=[pipe for pipe in ['tagger', 'parser', 'ner']
+                                        if pipe not in components])
+        if 'neuralcoref' in components:
+            # neuralcoref downloads its model at import time unless it is in its cache
+            require('neuralcoref_model')
+            os.environ.setdefault('NEURALCOREF_CACHE', NEURALCOREF_CACHE)
+            import neuralcoref
+            neuralcoref.add_to_pipe(nlp)
+        loaded[name] = nlp
+
+    pipelines = {}
+    for role in roles:
+        nlp = loaded[models[role]]
+        tokenizer = query_tokenizer(nlp) if role == 'query' else None
+        pipelines[role] = Pipeline(nlp, ROLES[role], tokenizer)
+    return pipelines
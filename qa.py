@@ -2,6 +2,11 @@ import argparse
 import sys
 import requests
 import json
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 
 
 OPTS = None
@@ -14,6 +19,21 @@ def parse_args():
     parser.add_argument('-q', '--question', dest='question', metavar='W', nargs='+',
                         help='Question to be answered.')
 
+    parser.add_argument('-f', '--file', dest='file',
+                        help='File with one question per line, "-" to read from stdin. '
+                             'Answers are written as NDJSON as they complete.')
+
+    parser.add_argument('-c', '--concurrency', dest='concurrency', type=int, default=4,
+                        help='Number of questions sent at the same time with --file.')
+
+    parser.add_argument('-s', '--session', dest='session',
+                        help='Session id of every question sent with --file, so that they form one '
+                             'conversation (default: a new session per question, without coreference '
+                             'between the questions).')
+
+    parser.add_argument('-u', '--url', dest='url', default='http://127.0.0.1:5000/',
+                        help='URL of the PLACAT backend.')
+
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Verbose mode.')
 
@@ -24,20 +44,76 @@ def parse_args():
     return parser.parse_args()
 
 
-def main():
-    question = ' '.join(OPTS.question)
-
-    url = 'http://127.0.0.1:5000/'
+def ask(session, question, sessionID):
     headers = { 'Content-Type': 'application/json' }
     payload = { 'queryResult': { 'queryText': question },
-                'session': '123456' }
+                'session': sessionID }
 
-    r = requests.post(url, data=json.dumps(payload), headers=headers)
+    r = session.post(OPTS.url, data=json.dumps(payload), headers=headers)
 
     answer = r.json()['fulfillmentText']
     if not answer:
         answer = 'No answer'
 
+    return answer
+
+
+def ask_timed(session, question, sessionID=None):
+    # Each question gets its own session so that no coreference is done between
+    # them, the server drops idle sessions after SessionTTL seconds
+    sessionID = sessionID or 'qa-' + uuid.uuid4().hex
+    start = time.time()
+    try:
+        answer = ask(session, question, sessionID)
+        error = None
+    except Exception as e:
+        answer = None
+        error = str(e)
+    result = { 'question': question, 'answer': answer, 'latency': time.time() - start }
+    if error:
+        result['error'] = error
+    return result
+
+
+def read_questions():
+    f = sys.stdin if OPTS.file == '-' else open(OPTS.file, encoding='utf-8')
+    try:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def main_batch():
+    # Pooled keep-alive connections shared by the worker threads
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=OPTS.concurrency))
+    session.mount('https://', HTTPAdapter(pool_maxsize=OPTS.concurrency))
+
+    # Questions are read lazily, with at most twice the concurrency in flight
+    pending = set()
+    with ThreadPoolExecutor(max_workers=OPTS.concurrency) as executor:
+        for question in read_questions():
+            pending.add(executor.submit(ask_timed, session, question, OPTS.session))
+            if len(pending) >= 2 * OPTS.concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    print(json.dumps(future.result()), flush=True)
+        for future in as_completed(pending):
+            print(json.dumps(future.result()), flush=True)
+
+
+def main():
+    if OPTS.file:
+        main_batch()
+        return
+
+    question = ' '.join(OPTS.question)
+
+    answer = ask(requests, question, '123456')
+
     print(answer)
 
 
@@ -0,0 +1,130 @@
+import math
+import re
+
+import numpy as np
+
+
+# Re-ranking of the passages carved out of the Elasticsearch hits, before they
+# are read by BERT. Each passage is a (text, score, title, ...) tuple, the score
+# of the re-ranked passages is replaced by the score of the re-ranker.
+
+
+class Reranker(object):
+    """
+    Base class of the re-rankers: `score` returns one score per passage text,
+    higher is better. `rerank` sorts the passages by these scores and keeps
+    an adaptive number of them (see `adaptive_top_k`).
+    """
+
+    def __init__(self, min_passages=1, max_passages=5, keep_ratio=0.5):
+        self.min_passages = min_passages
+        self.max_passages = max_passages
+        self.keep_ratio = keep_ratio
+
+    def score(self, question, texts):
+        raise NotImplementedError
+
+    def rerank(self, question, passages):
+        if not passages:
+            return []
+        scores = self.score(question, [passage[0] for passage in passages])
+        ranked = sorted(((passage[0], float(score)) + tuple(passage[2:]) for passage, score in zip(passages, scores)),
+                        key=lambda p: p[1], reverse=True)
+        return adaptive_top_k(ranked, self.min_passages, self.max_passages, self.keep_ratio, passages)
+
+
+def adaptive_top_k(ranked, min_passages, max_passages, keep_ratio, original=None):
+    # Keeps the passages scoring at least `keep_ratio` times the best score:
+    # one clear winner gives one BERT pass, close scores give up to `max_passages`.
+    # Without any positive score the re-ranker tells nothing, and the passages
+    # are read in their `original` retrieval order instead.
+    best = ranked[0][1]
+    if best <= 0:
+        return list(original if original is not None else ranked)[:max_passages]
+    k = sum(1 for passage in ranked if passage[1] >= keep_ratio * best)
+    return ranked[:max(min_passages, min(k, max_passages))]
+
+
+class LexicalReranker(Reranker):
+    """Keeps the retrieval order and scores, only applies the adaptive cut."""
+
+    def rerank(self, question, passages):
+        if not passages:
+            return []
+        ranked = sorted(passages, key=lambda p: p[1], reverse=True)
+        return adaptive_top_k(ranked, self.min_passages, self.max_passages, self.keep_ratio, passages)
+
+
+class BM25Reranker(Reranker):
+    """
+    Okapi BM25 of the question terms over the candidate passages, the document
+    frequencies being those of the candidates.
+    """
+
+    def __init__(self, stop_words=(), k1=1.2, b=0.75, **kwargs):
+        super(BM25Reranker, self).__init__(**kwargs)
+        self.stop_words = set(stop_words)
+        self.k1 = k1
+        self.b = b
+
+    def terms(self, text):
+        return [w for w in re.findall(r'\w+', text.lower()) if w not in self.stop_words]
+
+    def score(self, question, texts):
+        documents = [self.terms(text) for text in texts]
+        n = len(documents)
+        average_length = sum(len(d) for d in documents) / max(n, 1) or 1.0
+        frequencies = []
+        document_frequency = {}
+        for document in documents:
+            counts = {}
+            for term in document:
+                counts[term] = counts.get(term, 0) + 1
+            frequencies.append(counts)
+            for term in counts:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+
+        scores = []
+        question_terms = set(self.terms(question))
+        for document, counts in zip(documents, frequencies):
+            norm = self.k1 * (1 - self.b + self.b * len(document) / average_length)
+            score = 0.0
+            for term in question_terms:
+                tf = counts.get(term, 0)
+                if tf:
+                    df = document_frequency[term]
+                    idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                    score += idf * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+
+class VectorReranker(Reranker):
+    """
+    Cosine similarity between the spaCy vectors of the question and of the
+    passages. `vectors` maps a list of texts to their vectors.
+    """
+
+    def __init__(self, vectors, **kwargs):
+        super(VectorReranker, self).__init__(**kwargs)
+        self.vectors = vectors
+
+    def score(self, question, texts):
+        matrix = np.asarray(self.vectors([question] + list(texts)), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1)
+        norms[norms == 0] = 1.0
+        matrix = matrix / norms[:, None]
+        return matrix[1:].dot(matrix[0])
+
+
+RERANKERS = {
+    'lexical': LexicalReranker,
+    'bm25': BM25Reranker,
+    'vectors': VectorReranker
+}
+
+
+def make_reranker(name, **kwargs):
+    if name not in RERANKERS:
+        raise ValueError(name, "is not a known passage re-ranker.")
+    return RERANKERS[name](**kwargs)
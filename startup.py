@@ -0,0 +1,112 @@
+import _thread
+import collections
+import os
+import resource
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def rss_mb():
+    # Current resident set size, from /proc on Linux
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        # Peak instead of current size, ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Startup(object):
+    """
+    Loads independent components concurrently in background threads, most of
+    the loading time being disk reads and deserialization. `ready` is only set
+    once every component has been loaded and warmed up, and the load time and
+    memory of each component are kept in `report` (memory deltas are
+    approximate since the components are loaded at the same time).
+    """
+
+    def __init__(self):
+        self.loaders = collections.OrderedDict()
+        self.components = {}
+        self.report = collections.OrderedDict()
+        self.ready = threading.Event()
+        self.error = None
+        self.thread = None
+        self.phase = 'loading'
+        self.warmup_report = None
+
+    def add(self, name, loader):
+        self.loaders[name] = loader
+        self.report[name] = { 'state': 'pending' }
+
+    def _load(self, name, loader):
+        self.report[name]['state'] = 'loading'
+        start, rss = time.time(), rss_mb()
+        component = loader()
+        self.report[name].update({
+            'state': 'loaded',
+            'seconds': round(time.time() - start, 3),
+            'rss_delta_mb': round(rss_mb() - rss, 1)
+        })
+        return component
+
+    def run(self):
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=len(self.loaders)) as executor:
+            futures = { executor.submit(self._load, name, loader): name
+                        for name, loader in self.loaders.items() }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    self.components[name] = future.result()
+                except Exception as e:
+                    self.report[name]['state'] = 'failed'
+                    self.report[name]['error'] = repr(e)
+                    raise
+                print('*** {} loaded in {:.1f}s ({:+.0f} MB) ***'.format(
+                    name, self.report[name]['seconds'], self.report[name]['rss_delta_mb']))
+        print('*** All components loaded in {:.1f}s, {:.0f} MB ***'.format(time.time() - start, rss_mb()))
+        return self.components
+
+    def start(self, on_loaded, warmup=None):
+        """
+        Loads the components in the background and calls `on_loaded` with the
+        dict of loaded components, then `warmup` (which returns a report of the
+        warmup, e.g. the time of each step), before setting `ready`. A failure
+        stops the application instead of leaving it running and never ready.
+        """
+        def target():
+            try:
+                on_loaded(self.run())
+                if warmup is not None:
+                    self.phase = 'warmup'
+                    start = time.time()
+                    self.warmup_report = warmup()
+                    print('*** Warmup done in {:.1f}s ***'.format(time.time() - start))
+            except Exception as e:
+                self.phase = 'failed'
+                self.error = e
+                traceback.print_exc()
+                _thread.interrupt_main()
+                return
+            self.phase = 'ready'
+            self.ready.set()
+
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def wait(self, timeout=None):
+        # False if the components are still loading after `timeout` seconds
+        return self.ready.wait(timeout)
+
+    def status(self):
+        return {
+            'ready': self.ready.is_set(),
+            'phase': self.phase,
+            'error': repr(self.error) if self.error is not None else None,
+            'components': self.report,
+            'warmup': self.warmup_report
+        }
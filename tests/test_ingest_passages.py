@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip('nltk')
+pytest.importorskip('dotenv')
+pytest.importorskip('elasticsearch')
+
+from ingest_passages import passage_positions
+
+
+def covered(n, length, stride):
+    return set(i for position in passage_positions(n, length, stride)
+               for i in range(position, min(n, position + length)))
+
+
+@pytest.mark.parametrize('n', range(1, 25))
+@pytest.mark.parametrize('length, stride', [(3, 2), (3, 1), (3, 3), (4, 3), (5, 2)])
+def test_every_sentence_is_in_a_passage(n, length, stride):
+    assert covered(n, length, stride) == set(range(n))
+
+
+def test_last_window_ends_on_last_sentence():
+    assert passage_positions(4, 3, 2) == [0, 1]
+    assert passage_positions(10, 3, 2) == [0, 2, 4, 6, 7]
+    assert passage_positions(9, 3, 2) == [0, 2, 4, 6]
+    assert passage_positions(2, 3, 2) == [0]
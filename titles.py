@@ -0,0 +1,137 @@
+import argparse
+import gzip
+import json
+import os
+import re
+import string
+import sys
+
+import numpy as np
+
+from spacy.lang.en.stop_words import STOP_WORDS
+
+
+# Dictionary of the article titles and redirects of a CirrusSearch dump, used to
+# answer "What is X ?" questions from the opening text of article X without a
+# full search. The normalized titles are stored sorted in one flat file and
+# looked up by binary search over memory-mapped arrays.
+
+FIVE_W = {'who', 'what', 'when', 'where', 'why'}
+
+DEFINITION_QUESTION = re.compile(r"^\s*(?:what|who)(?:\s+(?:is|are|was|were)|'s)\s+(.+?)\s*[?.!]*\s*$", re.IGNORECASE)
+
+PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+
+OPTS = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build the title and redirect dictionary of a CirrusSearch dump.')
+
+    parser.add_argument('-i', '--input', dest='input', required=True,
+                        help='CirrusSearch dump, e.g. simplewiki-20190114-cirrussearch-content.json.gz')
+
+    parser.add_argument('-o', '--output', dest='output', required=True,
+                        help='Output directory, e.g. data/simplewiki_titles')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    return parser.parse_args()
+
+
+def title_key(text):
+    # Same stripping as the Elasticsearch query: lowercase, no punctuation, no stop words or 5W words
+    words = text.lower().translate(PUNCTUATION).split()
+    return ' '.join(w for w in words if w not in STOP_WORDS and w not in FIVE_W)
+
+
+def definition_subject(question):
+    # "What is X ?" / "Who was X ?" -> X, None for other questions
+    match = DEFINITION_QUESTION.match(question)
+    return match.group(1) if match else None
+
+
+class TitleIndex(object):
+    """
+    Sorted title keys in `keys.bin` (UTF-8, concatenated), their offsets in
+    `offsets.bin` and the page id of each key in `ids.bin`.
+    """
+
+    def __init__(self, directory):
+        self.offsets = np.fromfile(os.path.join(directory, 'offsets.bin'), dtype=np.int64)
+        self.ids = np.fromfile(os.path.join(directory, 'ids.bin'), dtype=np.int64)
+        self.keys = np.memmap(os.path.join(directory, 'keys.bin'), dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def key(self, i):
+        return self.keys[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def lookup(self, text):
+        """Page id of the title or redirect `text`, None if there is none."""
+        key = title_key(text).encode('utf-8')
+        if not key:
+            return None
+        low, high = 0, len(self.ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.ids) and self.key(low) == key:
+            return int(self.ids[low])
+        return None
+
+
+def is_disambiguation(page):
+    return any('disambiguation' in category.lower() for category in page.get('category', []))
+
+
+def read_entries(path):
+    # (key, priority, page id): titles come before the redirects with the same key
+    f = gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, encoding='utf-8')
+    with f:
+        page_id = None
+        for line in f:
+            record = json.loads(line)
+            if 'index' in record:
+                page_id = record['index'].get('_id')
+                continue
+            if not record.get('title') or not page_id or not page_id.isdigit() or is_disambiguation(record):
+                continue
+            yield title_key(record['title']).encode('utf-8'), 0, int(page_id)
+            for redirect in record.get('redirect', []):
+                if redirect.get('namespace', 0) == 0:
+                    yield title_key(redirect['title']).encode('utf-8'), 1, int(page_id)
+
+
+def main():
+    entries = sorted(entry for entry in read_entries(OPTS.input) if entry[0])
+
+    os.makedirs(OPTS.output, exist_ok=True)
+    offsets, ids = [0], []
+    previous = None
+    with open(os.path.join(OPTS.output, 'keys.bin'), 'wb') as f:
+        for key, _, page_id in entries:
+            if key == previous:
+                continue
+            previous = key
+            f.write(key)
+            offsets.append(offsets[-1] + len(key))
+            ids.append(page_id)
+    np.asarray(offsets, dtype=np.int64).tofile(os.path.join(OPTS.output, 'offsets.bin'))
+    np.asarray(ids, dtype=np.int64).tofile(os.path.join(OPTS.output, 'ids.bin'))
+
+    print('{} titles and redirects written to {} ({:.1f} MB)'.format(
+        len(ids), OPTS.output, (offsets[-1] + 16 * len(ids)) / (1024 * 1024)))
+
+
+if __name__ == '__main__':
+    OPTS = parse_args()
+    main()
@@ -0,0 +1,155 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+from os.path import join, dirname
+from dotenv import load_dotenv
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.optim as optim
+
+from distributed import average_gradients, broadcast_parameters, init_process_group
+
+# Loaded at import time so that the spawned processes see the same configuration
+load_dotenv(join(dirname(__file__), '.env'))
+
+
+OPTS = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Data-parallel CPU training of the controller or of the chatbot.')
+
+    parser.add_argument('model', choices=['controller', 'chatbot'],
+                        help='Model to train.')
+
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=1,
+                        help='Number of training processes, the gradients of their batches are averaged.')
+
+    parser.add_argument('-t', '--threads', dest='threads', type=int,
+                        help='Threads per process (default: number of cores / processes).')
+
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=64,
+                        help='Batch size of each process.')
+
+    parser.add_argument('-n', '--iterations', dest='iterations', type=int, default=4000,
+                        help='Chatbot: number of training iterations.')
+
+    parser.add_argument('-e', '--epochs', dest='epochs', type=int, default=100,
+                        help='Controller: number of epochs.')
+
+    parser.add_argument('-s', '--save-every', dest='save_every', type=int, default=500,
+                        help='Save a checkpoint every N iterations (chatbot) or epochs (controller).')
+
+    parser.add_argument('-r', '--resume', dest='resume', type=int,
+                        help='Chatbot: resume from the checkpoint of this iteration.')
+
+    parser.add_argument('-l', '--learning-rate', dest='learning_rate', type=float, default=0.1,
+                        help='Controller: learning rate.')
+
+    parser.add_argument('-o', '--output', dest='output',
+                        help='Controller: output model file, e.g. data/controller.pt')
+
+    parser.add_argument('--port', dest='port', type=int, default=29500,
+                        help='Local port used by the processes to communicate.')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    return parser.parse_args()
+
+
+def train_controller(rank, world_size, opts):
+    from controller import Controller
+
+    controller = Controller(load_model=False)
+    model = controller.model
+    parameters = list(model.parameters())
+    if world_size > 1:
+        broadcast_parameters(parameters)
+
+    # Each process trains on its own shard, with the same number of steps
+    shard = controller.data[rank::world_size]
+    steps = len(controller.data) // world_size // opts.batch_size
+    rng = random.Random(rank)
+
+    loss_function = nn.NLLLoss()
+    optimizer = optim.SGD(parameters, lr=opts.learning_rate)
+    model.train()
+    for epoch in range(1, opts.epochs + 1):
+        start = time.time()
+        rng.shuffle(shard)
+        total_loss = 0
+        for step in range(steps):
+            batch = shard[step * opts.batch_size:(step + 1) * opts.batch_size]
+            bow_vectors = controller.make_bow_vectors([sentence for sentence, _ in batch])
+            targets = controller.make_targets([label for _, label in batch])
+
+            optimizer.zero_grad()
+            loss = loss_function(model(bow_vectors), targets)
+            loss.backward()
+            if world_size > 1:
+                average_gradients(parameters)
+            optimizer.step()
+            total_loss += loss.item()
+
+        if rank == 0:
+            print('Epoch: {}; Average loss: {:.4f}; Sentences/s: {:.0f}'.format(
+                epoch, total_loss / max(steps, 1), steps * opts.batch_size * world_size / (time.time() - start)))
+            if epoch % opts.save_every == 0 or epoch == opts.epochs:
+                torch.save(model.state_dict(), opts.output)
+
+    if rank == 0:
+        model.eval()
+        with torch.no_grad():
+            correct = sum(controller.define_class(' '.join(sentence)) == controller.label_to_ix[label]
+                          for sentence, label in controller.test_data)
+        print('Test accuracy: {:.4f}'.format(correct / max(len(controller.test_data), 1)))
+
+
+def train_chatbot(rank, world_size, opts):
+    from chatbot import Chatbot
+
+    # Training runs in the constructor, checkpoints are written to data/save/
+    Chatbot(os.getenv('ChatbotModelName'),
+            os.getenv('ChatbotDataFile'),
+            opts.resume or 0,
+            do_training=True,
+            resume_training=opts.resume is not None,
+            n_iteration=opts.iterations,
+            batch_size=opts.batch_size,
+            save_every=opts.save_every,
+            world_size=world_size,
+            rank=rank)
+
+
+def worker(rank, world_size, opts):
+    torch.set_num_threads(opts.threads or max(1, (os.cpu_count() or 1) // world_size))
+    if world_size > 1:
+        init_process_group(rank, world_size, opts.port)
+
+    if opts.model == 'controller':
+        train_controller(rank, world_size, opts)
+    else:
+        train_chatbot(rank, world_size, opts)
+
+
+def main():
+    if OPTS.model == 'controller' and not OPTS.output:
+        sys.exit('--output is required to train the controller')
+
+    if OPTS.processes > 1:
+        mp.spawn(worker, args=(OPTS.processes, OPTS), nprocs=OPTS.processes)
+    else:
+        worker(0, 1, OPTS)
+
+
+if __name__ == '__main__':
+    OPTS = parse_args()
+    main()